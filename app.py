@@ -1,33 +1,24 @@
 import argparse
 import os
 from datetime import datetime
-from openai import AzureOpenAI
 import gradio as gr
 import numpy as np
 import torch
 from diffusers.image_processor import VaeImageProcessor
 from huggingface_hub import snapshot_download
 from PIL import Image
-import base64
+from llm import cached_cloth_description, submit_campaign_copy
+from model.cache import GarmentLatentCache, ParsingCache, PromptEmbedsCache
 from model.cloth_masker import AutoMasker, vis_mask
+from model.person_generator import FluxPersonGenerator
 from model.pipeline import CatVTONPipeline
 from utils import init_weight_dtype, resize_and_crop, resize_and_padding
 from dotenv import load_dotenv
-from io import BytesIO
 
 
 load_dotenv()
 
 import gc
-from transformers import T5EncoderModel
-from diffusers import FluxPipeline, FluxTransformer2DModel
-
-openai_client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-            api_version="2024-02-15-preview",
-            azure_deployment="gpt-4o-mvp-dev"
-)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
@@ -97,6 +88,40 @@ def parse_args():
             " flag passed with the `accelerate.launch` command. Use this argument to override the accelerate config."
         ),
     )
+    parser.add_argument(
+        "--person_gen_memory_budget",
+        type=float,
+        default=None,
+        help=(
+            "GPU memory (GiB) the text-to-person FLUX models may keep resident; stages that do not fit are CPU"
+            " offloaded. Defaults to the free GPU memory once the try-on models are loaded, minus"
+            " --person_gen_memory_headroom."
+        ),
+    )
+    parser.add_argument(
+        "--person_gen_memory_headroom",
+        type=float,
+        default=6,
+        help=(
+            "GPU memory (GiB) kept free for try-on and generation activations when --person_gen_memory_budget is not"
+            " set."
+        ),
+    )
+    parser.add_argument(
+        "--prompt_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Optional directory to persist FLUX prompt embeddings (safetensors) across restarts. Its size is bounded by"
+            " --prompt_cache_max_disk_gb; the in-memory limit does not apply to it."
+        ),
+    )
+    parser.add_argument(
+        "--prompt_cache_max_disk_gb",
+        type=float,
+        default=4,
+        help="Disk budget (GiB) of --prompt_cache_dir; the least recently used entries are deleted past it.",
+    )
     
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
@@ -127,13 +152,6 @@ def flush():
 
 flush()
 
-ckpt_4bit_id = "sayakpaul/flux.1-dev-nf4-pkg"
-
-text_encoder_2_4bit = T5EncoderModel.from_pretrained(
-    ckpt_4bit_id,
-    subfolder="text_encoder_2",
-)
-
 # image gen pipeline
 # Pipeline
 pipeline = CatVTONPipeline(
@@ -142,7 +160,9 @@ pipeline = CatVTONPipeline(
     attn_ckpt_version="mix",
     weight_dtype=init_weight_dtype(args.mixed_precision),
     use_tf32=args.allow_tf32,
-    device='cuda'
+    device='cuda',
+    # entries are device tensors: this bounds GPU memory held by cached garment latents
+    latent_cache=GarmentLatentCache(max_bytes=1 << 30),
 )
 # AutoMasker
 mask_processor = VaeImageProcessor(vae_scale_factor=8, do_normalize=False, do_binarize=True, do_convert_grayscale=True)
@@ -150,6 +170,18 @@ automasker = AutoMasker(
     densepose_ckpt=os.path.join(repo_path, "DensePose"),
     schp_ckpt=os.path.join(repo_path, "SCHP"),
     device='cuda', 
+    parsing_cache=ParsingCache(max_bytes=256 << 20),
+)
+# Text-to-person generator, loaded once and kept warm between requests
+person_generator = FluxPersonGenerator(
+    memory_budget=int(args.person_gen_memory_budget * (1 << 30)) if args.person_gen_memory_budget is not None else None,
+    memory_headroom=int(args.person_gen_memory_headroom * (1 << 30)),
+    prompt_cache=PromptEmbedsCache(
+        max_bytes=256 << 20,
+        cache_dir=args.prompt_cache_dir,
+        device='cuda',
+        max_disk_bytes=int(args.prompt_cache_max_disk_gb * (1 << 30)),
+    ),
 )
 
 def submit_function(
@@ -181,6 +213,9 @@ def submit_function(
     if seed != -1:
         generator = torch.Generator(device='cuda').manual_seed(seed)
 
+    # Product description and campaign captions are fetched while the GPU runs masking and denoising. They are keyed
+    # on the uploaded file, like the description fetched by `cloth_image.change`, so that one is reused here.
+    campaign_copy = submit_campaign_copy(cloth_image, cloth_type, campaign_context)
     person_image = Image.open(person_image).convert("RGB")
     cloth_image = Image.open(cloth_image).convert("RGB")
     person_image = resize_and_crop(person_image, (args.width, args.height))
@@ -216,11 +251,7 @@ def submit_function(
     masked_person = vis_mask(person_image, mask)
     save_result_image = image_grid([person_image, masked_person, cloth_image, result_image], 1, 4)
     save_result_image.save(result_save_path)
-    # Generate product description
-    product_description = generate_upper_cloth_description(cloth_image, cloth_type)
-    
-    # Generate captions for the campaign
-    captions = generate_captions(product_description, campaign_context)
+    product_description, captions = campaign_copy.result()
 
     if show_type == "result only":
         return result_image
@@ -248,57 +279,16 @@ def generate_person_image(text, cloth_description):
     Returns the path to the generated image.
     """
     prompt = generate_ai_model_prompt(text, cloth_description)
-    ckpt_id = "black-forest-labs/FLUX.1-dev"
 
     print("generating image with prompt: ", prompt)
-    image_gen_pipeline = FluxPipeline.from_pretrained(
-        ckpt_id,
-        text_encoder_2=text_encoder_2_4bit,
-        transformer=None,
-        vae=None,
-        torch_dtype=torch.float16,
-    )
-    image_gen_pipeline.enable_model_cpu_offload()
-    # Create a new image with a random background color
-
-    with torch.no_grad():
-        print("Encoding prompts.")
-        prompt_embeds, pooled_prompt_embeds, text_ids = image_gen_pipeline.encode_prompt(
-            prompt=prompt, prompt_2=None, max_sequence_length=256
-        )
-
-    image_gen_pipeline = image_gen_pipeline.to("cpu")
-    del image_gen_pipeline
-
-    flush()
-
-    print(f"prompt_embeds shape: {prompt_embeds.shape}")
-    print(f"pooled_prompt_embeds shape: {pooled_prompt_embeds.shape}")
-    # Add the prompt text to the image
-    transformer_4bit = FluxTransformer2DModel.from_pretrained(ckpt_4bit_id, subfolder="transformer")
-    image_gen_pipeline = FluxPipeline.from_pretrained(
-        ckpt_id,
-        text_encoder=None,
-        text_encoder_2=None,
-        tokenizer=None,
-        tokenizer_2=None,
-        transformer=transformer_4bit,
-        torch_dtype=torch.float16,
-    )
-    image_gen_pipeline.enable_model_cpu_offload()
-
-    print("Running denoising.")
-    height, width = 1024, 1024
-
-    images = image_gen_pipeline(
-        prompt_embeds=prompt_embeds,
-        pooled_prompt_embeds=pooled_prompt_embeds,
+    images = person_generator(
+        prompt,
+        height=1024,
+        width=1024,
         num_inference_steps=50,
         guidance_scale=5.5,
-        height=height,
-        width=width,
-        output_type="pil",
-    ).images
+        max_sequence_length=256,
+    )
     
     # Add current time to make each image unique
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -312,160 +302,10 @@ def generate_person_image(text, cloth_description):
     
     return output_path
 
-def pil_image_to_base64(image, format: str = "PNG") -> str:
-    """
-    Converts an image to a Base64 encoded string.
-
-    Args:
-        image: Either a file path (str) or a PIL Image object
-        format (str): The format to save the image as (default is PNG).
-
-    Returns:
-        str: A Base64 encoded string of the image.
-    """
-    try:
-        # If image is a file path, open it
-        if isinstance(image, str):
-            image = Image.open(image)
-        elif not isinstance(image, Image.Image):
-            raise ValueError("Input must be either a file path or a PIL Image object")
-        
-        # Convert the image to Base64
-        buffered = BytesIO()
-        image.save(buffered, format=format)
-        buffered.seek(0)  # Go to the start of the BytesIO stream
-        image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        return image_base64
-    except Exception as e:
-        print(f"Error converting image to Base64: {e}")
-        raise e
-
-def generate_upper_cloth_description(product_image, cloth_type: str):
-    try:
-        base_64_image = pil_image_to_base64(product_image)
-
-        if cloth_type == "upper":
-            system_prompt = """
-                You are world class fahsion designer
-                Your task is to Write a detailed description of the upper body garment shown in the image, focusing on its fit, sleeve style, fabric type, neckline, and any notable design elements or features in one or two lines for given image.
-                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
-            """
-        elif cloth_type == "lower":
-            system_prompt = """
-                You are world class fahsion designer
-                Your task is to Write a detailed description of the lower body garment shown in the image, focusing on its fit, fabric type, waist style, and any notable design elements or features in one or two lines for given image.
-                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
-            """
-        elif cloth_type == "overall":
-            system_prompt = """
-                You are world class fahsion designer
-                Your task is to Write a detailed description of the overall garment shown in the image, focusing on its fit, fabric type, sleeve style, neckline, and any notable design elements or features in one or two lines for given image.
-                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
-            """
-        else:
-            system_prompt = """
-                You are world class fahsion designer
-                Your task is to Write a detailed description of the upper body garment shown in the image, focusing on its fit, sleeve style, fabric type, neckline, and any notable design elements or features in one or two lines for given image.
-                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
-            """
-
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {
-                       "type": "image_url",
-                       "image_url": {
-                            "url": f"data:image/jpeg;base64,{base_64_image}"
-                       }
-                    }
-                ]},
-            ],
-        )
-
-        return response.choices[0].message.content
-    except Exception as e:
-        print(f"Error in generate_upper_cloth_description: {e}")
-        raise e
-
-def generate_caption_for_image(image):
-    """
-    Generates a caption for the given image using OpenAI's vision model.
-    """
-    if image is None:
-        return "Please generate a try-on result first."
-    
-    # Convert the image to base64
-    if isinstance(image, str):
-        base64_image = pil_image_to_base64(image)
-    else:
-        # Convert numpy array to PIL Image
-        if isinstance(image, np.ndarray):
-            image = Image.fromarray((image * 255).astype(np.uint8))
-        buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-    system_prompt = """
-        You are a world class campaign generator for cloth that model is wearing.
-        Create campaign caption for the image shown below. 
-        create engaging campaign captions for products in the merchandise for instagram stories that attract, convert and retain customers.
-    """
-
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]},
-            ],
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"Error generating caption: {str(e)}"
-
 def generate_ai_model_prompt(model_description, product_description):
     print("prompt for ai model generation", f" {model_description} wearing {product_description}.")
     return f" {model_description} wearing {product_description}, full image"
 
-def generate_captions(product_description, campaign_context):
-    
-    #system prompt
-    system_prompt = """
-        You are a world-class marketing expert.
-        Your task is to create engaging, professional, and contextually relevant campaign captions based on the details provided.
-        Use creative language to highlight the product's key features and align with the campaign's goals.
-        Ensure the captions are tailored to the specific advertising context provided.
-    """
-
-    #  user prompt
-    user_prompt = f"""
-    Campaign Context: {campaign_context}
-    Product Description: {product_description}
-    Generate captivating captions for this campaign that align with the provided context.
-    """
-    
-    # Call OpenAI API
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-    )
-
-    # Extract generated captions
-    captions = response.choices[0].message.content.strip()
-    return captions
-
 
 HEADER = """
 """
@@ -529,7 +369,7 @@ def app_gradio():
                         )
 
                     cloth_image.change(
-                            generate_upper_cloth_description,
+                            cached_cloth_description,
                             inputs=[cloth_image, cloth_type],
                             outputs=[cloth_description],
                         )
@@ -59,6 +59,17 @@ def parse_args():
         default=1024,
         help="The height of the input image."
     )
+    parser.add_argument(
+        "--first_block_cache_threshold",
+        type=float,
+        default=None,
+        help="Enable the transformer's first-block cache with this relative-change threshold (e.g. 0.08); off by default."
+    )
+    parser.add_argument(
+        "--prune_garment_tokens",
+        action="store_true",
+        help="Drop near-white garment tokens (e.g. padding) from the transformer sequence."
+    )
     return parser.parse_args()
 
 def image_grid(imgs, rows, cols):
@@ -122,7 +133,8 @@ def submit_function_flux(
         width=args.width,
         num_inference_steps=num_inference_steps,
         guidance_scale=guidance_scale,
-        generator=generator
+        generator=generator,
+        prune_garment_tokens=args.prune_garment_tokens,
     ).images[0]
 
     # Post-processing
@@ -287,6 +299,8 @@ pipeline_flux.load_lora_weights(
     weight_name='pytorch_lora_weights.safetensors'
 )
 pipeline_flux.to("cuda", torch.bfloat16)
+if args.first_block_cache_threshold is not None:
+    pipeline_flux.enable_first_block_cache(args.first_block_cache_threshold)
 
 # 初始化 AutoMasker
 mask_processor = VaeImageProcessor(
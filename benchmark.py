@@ -0,0 +1,261 @@
+import argparse
+import itertools
+import os
+import time
+
+import torch
+from huggingface_hub import snapshot_download
+from prettytable import PrettyTable
+from torch.utils.data import DataLoader
+from torchmetrics.image import StructuralSimilarityIndexMeasure
+from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
+from torchvision import transforms
+from tqdm import tqdm
+
+from eval import eval as eval_metrics
+from inference import DressCodeTestDataset, VITONHDTestDataset
+from model.flux.pipeline_flux_tryon import FluxTryOnPipeline
+from model.flux.sampling import SAMPLERS, SIGMA_SCHEDULES
+from model.pipeline import CatVTONPipeline
+from utils import derive_generators, init_weight_dtype
+
+
+def load_batches(args):
+    """
+    The first `num_samples` pairs of the test set, collated in batches of `batch_size`.
+    """
+    if args.dataset_name == "vitonhd":
+        dataset = VITONHDTestDataset(args)
+    elif args.dataset_name == "dresscode":
+        dataset = DressCodeTestDataset(args)
+    else:
+        raise ValueError(f"Invalid dataset name {args.dataset_name}.")
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.dataloader_num_workers)
+    return list(itertools.islice(dataloader, -(-args.num_samples // args.batch_size)))
+
+
+@torch.no_grad()
+def run_pipeline(pipeline, batches, args, num_inference_steps=None, **kwargs):
+    """
+    Run `pipeline` over `batches` with per-sample generators, so every configuration sees the same noise.
+    Returns the results and the mean seconds per image, excluding a warmup batch.
+    """
+    num_inference_steps = args.num_inference_steps if num_inference_steps is None else num_inference_steps
+    pipeline(
+        batches[0]['person'], batches[0]['cloth'], batches[0]['mask'],
+        num_inference_steps=num_inference_steps, guidance_scale=args.guidance_scale,
+        height=args.height, width=args.width, **kwargs,
+    )
+    results = []
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for batch in tqdm(batches):
+        output = pipeline(
+            batch['person'], batch['cloth'], batch['mask'],
+            num_inference_steps=num_inference_steps,
+            guidance_scale=args.guidance_scale,
+            height=args.height,
+            width=args.width,
+            generator=derive_generators(args.seed, batch['person_name'], device='cuda'),
+            **kwargs,
+        )
+        results += getattr(output, "images", output)  # FLUX pipelines return a `FluxPipelineOutput`
+    torch.cuda.synchronize()
+    return results, (time.perf_counter() - start) / len(results)
+
+
+@torch.no_grad()
+def image_metrics(references, images) -> dict:
+    """
+    PSNR / SSIM / LPIPS of `images` against the exact-mode `references` (higher PSNR and SSIM, lower LPIPS is closer).
+    """
+    to_tensor = transforms.ToTensor()
+    ssim = StructuralSimilarityIndexMeasure(data_range=1.0).to("cuda")
+    lpips = LearnedPerceptualImagePatchSimilarity(net_type='squeeze').to("cuda")
+    psnr_score, ssim_score, lpips_score = 0, 0, 0
+    for reference, image in zip(references, images):
+        reference, image = to_tensor(reference)[None].to("cuda"), to_tensor(image)[None].to("cuda")
+        psnr_score += (10 * torch.log10(1 / torch.mean((reference - image) ** 2).clamp_min(1e-10))).item()
+        ssim_score += ssim(image, reference).item()
+        lpips_score += lpips(reference * 2 - 1, image * 2 - 1).item()
+    return {
+        "PSNR": psnr_score / len(images),
+        "SSIM": ssim_score / len(images),
+        "LPIPS": lpips_score / len(images),
+    }
+
+
+def load_pipeline(args) -> CatVTONPipeline:
+    return CatVTONPipeline(
+        attn_ckpt_version=args.dataset_name,
+        attn_ckpt=args.resume_path,
+        base_ckpt=args.base_model_path,
+        weight_dtype=init_weight_dtype(args.mixed_precision),
+        device="cuda",
+        skip_safety_check=True,
+    )
+
+
+def load_flux_pipeline(args) -> FluxTryOnPipeline:
+    pipeline = FluxTryOnPipeline.from_pretrained(args.base_model_path)
+    pipeline.load_lora_weights(
+        os.path.join(snapshot_download(repo_id=args.resume_path), "flux-lora"),
+        weight_name='pytorch_lora_weights.safetensors',
+    )
+    return pipeline.to("cuda", init_weight_dtype(args.mixed_precision))
+
+
+def save_and_score(args, names, images, tag) -> dict:
+    """
+    Write `images` under `output_dir/<tag>` and score them against `gt_folder` with `eval.py`.
+    """
+    pred_folder = os.path.join(args.output_dir, tag)
+    os.makedirs(pred_folder, exist_ok=True)
+    for name, image in zip(names, images):
+        image.save(os.path.join(pred_folder, name))
+    return eval_metrics(argparse.Namespace(
+        gt_folder=args.gt_folder, pred_folder=pred_folder, paired=args.eval_pair,
+        batch_size=16, num_workers=args.dataloader_num_workers,
+    ))
+
+
+def benchmark_kv_cache(args):
+    """
+    Speed and fidelity of the garment K/V cache at each refresh interval, relative to exact attention.
+    """
+    pipeline = load_pipeline(args)
+    batches = load_batches(args)
+    references, exact_time = run_pipeline(pipeline, batches, args)
+    table = PrettyTable()
+    table.field_names = ["Mode", "s/image", "Speedup", "Cached steps", "PSNR", "SSIM", "LPIPS"]
+    table.add_row(["exact", f"{exact_time:.3f}", "1.00x", 0, "-", "-", "-"])
+    for refresh_interval in args.refresh_intervals:
+        pipeline.enable_garment_kv_cache(refresh_interval, args.warmup_steps, args.final_steps)
+        images, seconds = run_pipeline(pipeline, batches, args)
+        metrics = image_metrics(references, images)
+        table.add_row([
+            f"kv-cache/{refresh_interval}", f"{seconds:.3f}", f"{exact_time / seconds:.2f}x",
+            pipeline.garment_kv_cache.num_cached_steps,
+            f"{metrics['PSNR']:.2f}", f"{metrics['SSIM']:.4f}", f"{metrics['LPIPS']:.4f}",
+        ])
+        pipeline.disable_garment_kv_cache()
+    print(table)
+
+
+def benchmark_samplers(args):
+    """
+    Step count vs quality for each sampler: results are written per (sampler, steps) and scored with `eval.py`.
+    """
+    pipeline = load_pipeline(args)
+    batches = load_batches(args)
+    names = [os.path.basename(name) for batch in batches for name in batch['person_name']]
+    table = PrettyTable()
+    table.field_names = ["Sampler", "Steps", "s/image", "FID", "KID", "SSIM", "LPIPS"]
+    for scheduler in args.schedulers:
+        for num_inference_steps in args.steps:
+            images, seconds = run_pipeline(pipeline, batches, args, num_inference_steps=num_inference_steps, scheduler=scheduler)
+            metrics = save_and_score(args, names, images, os.path.join("samplers", f"{scheduler}-{num_inference_steps}"))
+            table.add_row([
+                scheduler, num_inference_steps, f"{seconds:.3f}",
+                *(f"{metrics[key]:.4f}" if key in metrics else "-" for key in ["FID", "KID", "SSIM", "LPIPS"]),
+            ])
+    print(table)
+
+
+def benchmark_flux_samplers(args):
+    """
+    Step count vs quality for the FLUX try-on samplers and sigma schedules. Every configuration is compared with the
+    default scheduler at `num_inference_steps` (PSNR / SSIM / LPIPS), and scored against the ground truth with
+    `eval.py` if `--gt_folder` is set (`GT-` columns).
+    """
+    pipeline = load_flux_pipeline(args)
+    batches = load_batches(args)
+    names = [os.path.basename(name) for batch in batches for name in batch['person_name']]
+    references, reference_time = run_pipeline(pipeline, batches, args)
+    table = PrettyTable()
+    metric_keys = ["PSNR", "SSIM", "LPIPS", "GT-FID", "GT-KID", "GT-SSIM", "GT-LPIPS"]
+    table.field_names = ["Sampler", "Steps", "Sigmas", "NFE", "s/image", *metric_keys]
+    table.add_row(["scheduler", args.num_inference_steps, "linspace", args.num_inference_steps, f"{reference_time:.3f}", *["-"] * len(metric_keys)])
+    for sampler in args.samplers:
+        for num_inference_steps in args.steps:
+            for sigma_schedule in args.sigma_schedules:
+                images, seconds = run_pipeline(
+                    pipeline, batches, args, num_inference_steps=num_inference_steps,
+                    sampler=sampler, sigma_schedule=sigma_schedule,
+                )
+                metrics = image_metrics(references, images)
+                if args.gt_folder is not None:
+                    # kept apart from the reference metrics, which share the SSIM / LPIPS names
+                    gt_metrics = save_and_score(
+                        args, names, images, os.path.join("flux-samplers", f"{sampler}-{num_inference_steps}-{sigma_schedule}")
+                    )
+                    metrics.update({f"GT-{key}": value for key, value in gt_metrics.items()})
+                table.add_row([
+                    sampler, num_inference_steps, sigma_schedule,
+                    SAMPLERS[sampler].nfe_per_step * (num_inference_steps - 1) + 1, f"{seconds:.3f}",
+                    *(f"{metrics[key]:.4f}" if key in metrics else "-" for key in metric_keys),
+                ])
+    print(table)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed / quality benchmarks for the CatVTON and FLUX try-on pipelines.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--resume_path", type=str, default="zhengchong/CatVTON", help="The Path to the checkpoint of trained tryon model.")
+    common.add_argument("--dataset_name", type=str, required=True, choices=["vitonhd", "dresscode"])
+    common.add_argument("--data_root_path", type=str, required=True, help="Path to the dataset.")
+    common.add_argument("--output_dir", type=str, default="output/benchmark", help="Where benchmark outputs are written (test pairs already present in the dataset output layout are skipped).")
+    common.add_argument("--eval_pair", action="store_true", help="Use the paired test split.")
+    common.add_argument("--num_samples", type=int, default=32, help="Number of test pairs to run per configuration.")
+    common.add_argument("--batch_size", type=int, default=4)
+    common.add_argument("--num_inference_steps", type=int, default=50)
+    common.add_argument("--width", type=int, default=768)
+    common.add_argument("--height", type=int, default=1024)
+    common.add_argument("--seed", type=int, default=555)
+    common.add_argument("--dataloader_num_workers", type=int, default=4)
+    common.add_argument("--mixed_precision", type=str, default="bf16", choices=["no", "fp16", "bf16"])
+    # the SD-inpainting and FLUX pipelines differ in base model and guidance scale
+    catvton = argparse.ArgumentParser(add_help=False)
+    catvton.add_argument(
+        "--base_model_path",
+        type=str,
+        default="booksforcharlie/stable-diffusion-inpainting",
+        help="The path to the base model. This can be a local path or a model identifier from the Model Hub.",
+    )
+    catvton.add_argument("--guidance_scale", type=float, default=2.5)
+    flux = argparse.ArgumentParser(add_help=False)
+    flux.add_argument(
+        "--base_model_path",
+        type=str,
+        default="black-forest-labs/FLUX.1-Fill-dev",
+        help="The path to the FLUX Fill base model. This can be a local path or a model identifier from the Model Hub.",
+    )
+    flux.add_argument("--guidance_scale", type=float, default=30.0)
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    kv_cache = subparsers.add_parser("kv-cache", parents=[common, catvton], help="Garment K/V cache refresh intervals vs exact attention.")
+    kv_cache.add_argument("--refresh_intervals", type=int, nargs="+", default=[2, 3, 5])
+    kv_cache.add_argument("--warmup_steps", type=int, default=5)
+    kv_cache.add_argument("--final_steps", type=int, default=2)
+    kv_cache.set_defaults(func=benchmark_kv_cache)
+    samplers = subparsers.add_parser("samplers", parents=[common, catvton], help="Step count vs FID/KID (and SSIM/LPIPS when paired) per sampler.")
+    samplers.add_argument("--gt_folder", type=str, required=True, help="Ground-truth person images for eval.py.")
+    samplers.add_argument("--schedulers", type=str, nargs="+", default=["ddim", "dpm++", "unipc", "euler_a"])
+    samplers.add_argument("--steps", type=int, nargs="+", default=[15, 20, 25, 50])
+    samplers.set_defaults(func=benchmark_samplers)
+    flux_samplers = subparsers.add_parser(
+        "flux-samplers",
+        parents=[common, flux],
+        help="FLUX try-on samplers and sigma schedules vs the default scheduler at --num_inference_steps.",
+    )
+    flux_samplers.add_argument("--gt_folder", type=str, default=None, help="Ground-truth person images; also score with eval.py if set.")
+    flux_samplers.add_argument("--samplers", type=str, nargs="+", default=list(SAMPLERS))
+    flux_samplers.add_argument("--steps", type=int, nargs="+", default=[8, 12, 20])
+    flux_samplers.add_argument("--sigma_schedules", type=str, nargs="+", default=list(SIGMA_SCHEDULES), choices=SIGMA_SCHEDULES)
+    flux_samplers.set_defaults(func=benchmark_flux_samplers)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -143,6 +143,7 @@ def eval(args):
     table.field_names = header
     table.add_row(row)
     print(table)
+    return dict(zip(header, row))
     
          
 if __name__ == "__main__":
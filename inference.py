@@ -8,6 +8,7 @@ from tqdm import tqdm
 from PIL import Image, ImageFilter
 
 from model.pipeline import CatVTONPipeline
+from utils import derive_generators
 
 class InferenceDataset(Dataset):
     def __init__(self, args):
@@ -200,6 +201,16 @@ def parse_args():
         ),
     )
 
+    parser.add_argument(
+        "--enable_vae_slicing",
+        action="store_true",
+        help="Encode and decode one sample at a time to cap VAE memory for large batches.",
+    )
+    parser.add_argument(
+        "--enable_vae_tiling",
+        action="store_true",
+        help="Encode and decode in blended spatial tiles to cap VAE memory at large resolutions.",
+    )
     parser.add_argument(
         "--concat_axis",
         type=str,
@@ -264,6 +275,10 @@ def main():
         device="cuda",
         skip_safety_check=True
     )
+    if args.enable_vae_slicing:
+        pipeline.enable_vae_slicing()
+    if args.enable_vae_tiling:
+        pipeline.enable_vae_tiling()
     # Dataset
     if args.dataset_name == "vitonhd":
         dataset = VITONHDTestDataset(args)
@@ -279,7 +294,6 @@ def main():
         num_workers=args.dataloader_num_workers
     )
     # Inference
-    generator = torch.Generator(device='cuda').manual_seed(args.seed)
     args.output_dir = os.path.join(args.output_dir, f"{args.dataset_name}-{args.height}", "paired" if args.eval_pair else "unpaired")
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -287,6 +301,8 @@ def main():
         person_images = batch['person']
         cloth_images = batch['cloth']
         masks = batch['mask']
+        # one generator per sample, seeded from (seed, person_name), so results do not depend on batching
+        generator = derive_generators(args.seed, batch['person_name'], device='cuda')
         results = pipeline(
             person_images,
             cloth_images,
@@ -0,0 +1,219 @@
+import base64
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import AzureOpenAI, OpenAI
+from PIL import Image
+
+from model.cache import TextCache, content_hash
+
+
+def create_client():
+    """
+    Azure OpenAI client by default. Setting `OPENAI_BASE_URL` switches to a plain OpenAI-compatible client on that
+    endpoint instead, e.g. a local stub server for tests.
+    """
+    if os.getenv("OPENAI_BASE_URL"):
+        return OpenAI(base_url=os.getenv("OPENAI_BASE_URL"), api_key=os.getenv("OPENAI_API_KEY", "stub"))
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        api_version="2024-02-15-preview",
+        azure_deployment="gpt-4o-mvp-dev"
+    )
+
+
+load_dotenv()
+openai_client = create_client()
+# Responses for identical garments / campaigns are reused across submits
+# LLM_CACHE_DIR persists responses across restarts, bounded by LLM_CACHE_MAX_DISK_MB on disk
+response_cache = TextCache(
+    max_bytes=16 << 20,
+    cache_dir=os.getenv("LLM_CACHE_DIR"),
+    max_disk_bytes=int(float(os.getenv("LLM_CACHE_MAX_DISK_MB", 256)) * (1 << 20)),
+)
+# LLM calls are HTTP-bound, so they run on a few threads next to GPU denoising
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_MAX_WORKERS", 4)), thread_name_prefix="llm")
+
+def pil_image_to_base64(image, format: str = "PNG") -> str:
+    """
+    Converts an image to a Base64 encoded string.
+
+    Args:
+        image: Either a file path (str) or a PIL Image object
+        format (str): The format to save the image as (default is PNG).
+
+    Returns:
+        str: A Base64 encoded string of the image.
+    """
+    try:
+        # If image is a file path, open it
+        if isinstance(image, str):
+            image = Image.open(image)
+        elif not isinstance(image, Image.Image):
+            raise ValueError("Input must be either a file path or a PIL Image object")
+        
+        # Convert the image to Base64
+        buffered = BytesIO()
+        image.save(buffered, format=format)
+        buffered.seek(0)  # Go to the start of the BytesIO stream
+        image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        return image_base64
+    except Exception as e:
+        print(f"Error converting image to Base64: {e}")
+        raise e
+
+def generate_upper_cloth_description(product_image, cloth_type: str):
+    try:
+        base_64_image = pil_image_to_base64(product_image)
+
+        if cloth_type == "upper":
+            system_prompt = """
+                You are world class fahsion designer
+                Your task is to Write a detailed description of the upper body garment shown in the image, focusing on its fit, sleeve style, fabric type, neckline, and any notable design elements or features in one or two lines for given image.
+                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
+            """
+        elif cloth_type == "lower":
+            system_prompt = """
+                You are world class fahsion designer
+                Your task is to Write a detailed description of the lower body garment shown in the image, focusing on its fit, fabric type, waist style, and any notable design elements or features in one or two lines for given image.
+                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
+            """
+        elif cloth_type == "overall":
+            system_prompt = """
+                You are world class fahsion designer
+                Your task is to Write a detailed description of the overall garment shown in the image, focusing on its fit, fabric type, sleeve style, neckline, and any notable design elements or features in one or two lines for given image.
+                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
+            """
+        else:
+            system_prompt = """
+                You are world class fahsion designer
+                Your task is to Write a detailed description of the upper body garment shown in the image, focusing on its fit, sleeve style, fabric type, neckline, and any notable design elements or features in one or two lines for given image.
+                Don't start with "This image shows a pair of beige cargo ..." but instead start with "a pair of beige cargo ..."
+            """
+
+        response = openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": [
+                    {
+                       "type": "image_url",
+                       "image_url": {
+                            "url": f"data:image/jpeg;base64,{base_64_image}"
+                       }
+                    }
+                ]},
+            ],
+        )
+
+        return response.choices[0].message.content
+    except Exception as e:
+        print(f"Error in generate_upper_cloth_description: {e}")
+        raise e
+
+def generate_caption_for_image(image):
+    """
+    Generates a caption for the given image using OpenAI's vision model.
+    """
+    if image is None:
+        return "Please generate a try-on result first."
+    
+    # Convert the image to base64
+    if isinstance(image, str):
+        base64_image = pil_image_to_base64(image)
+    else:
+        # Convert numpy array to PIL Image
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray((image * 255).astype(np.uint8))
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        base64_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+    system_prompt = """
+        You are a world class campaign generator for cloth that model is wearing.
+        Create campaign caption for the image shown below. 
+        create engaging campaign captions for products in the merchandise for instagram stories that attract, convert and retain customers.
+    """
+
+    try:
+        response = openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
+                        }
+                    }
+                ]},
+            ],
+        )
+        return response.choices[0].message.content
+    except Exception as e:
+        return f"Error generating caption: {str(e)}"
+
+def generate_captions(product_description, campaign_context):
+    
+    #system prompt
+    system_prompt = """
+        You are a world-class marketing expert.
+        Your task is to create engaging, professional, and contextually relevant campaign captions based on the details provided.
+        Use creative language to highlight the product's key features and align with the campaign's goals.
+        Ensure the captions are tailored to the specific advertising context provided.
+    """
+
+    #  user prompt
+    user_prompt = f"""
+    Campaign Context: {campaign_context}
+    Product Description: {product_description}
+    Generate captivating captions for this campaign that align with the provided context.
+    """
+    
+    # Call OpenAI API
+    response = openai_client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+    )
+
+    # Extract generated captions
+    captions = response.choices[0].message.content.strip()
+    return captions
+
+
+def cached_cloth_description(product_image, cloth_type: str) -> str:
+    """
+    Garment description served from `response_cache`. Keys hash the image as given (file bytes for a path, pixels
+    for a PIL image), so callers should pass the same representation, e.g. the uploaded file path.
+    """
+    key = TextCache.make_key("description", content_hash(product_image), cloth_type)
+    if (description := response_cache.get(key)) is None:
+        description = generate_upper_cloth_description(product_image, cloth_type)
+        response_cache.put(key, description)
+    return description
+
+def cached_campaign_copy(product_image, cloth_type: str, campaign_context: str):
+    """
+    Garment description and campaign captions for one submit, each served from `response_cache` when the same
+    garment, cloth type and campaign context were seen before.
+    """
+    product_description = cached_cloth_description(product_image, cloth_type)
+    key = TextCache.make_key("captions", content_hash(product_image), cloth_type, campaign_context)
+    if (captions := response_cache.get(key)) is None:
+        captions = generate_captions(product_description, campaign_context)
+        response_cache.put(key, captions)
+    return product_description, captions
+
+def submit_campaign_copy(product_image, cloth_type: str, campaign_context: str) -> Future:
+    """
+    Start `cached_campaign_copy` on the executor; the future resolves to `(product_description, captions)`.
+    """
+    return executor.submit(cached_campaign_copy, product_image, cloth_type, campaign_context)
@@ -1,9 +1,5 @@
 
-import glob
 import os
-from random import randint
-import shutil
-import time
 
 import cv2
 import numpy as np
@@ -40,6 +36,8 @@ class DensePose:
         self.cfg = self.setup_config()
         self.predictor = DefaultPredictor(self.cfg)
         self.predictor.model.to(self.device)
+        # the extractor is stateless, so one context is shared by all calls
+        self.context = self.create_context(self.cfg)
 
     def setup_config(self):
         opts = ["MODEL.ROI_HEADS.SCORE_THRESH_TEST", str(self.min_score)]
@@ -51,18 +49,7 @@ class DensePose:
         cfg.freeze()
         return cfg
 
-    @staticmethod
-    def _get_input_file_list(input_spec: str):
-        if os.path.isdir(input_spec):
-            file_list = [os.path.join(input_spec, fname) for fname in os.listdir(input_spec)
-                         if os.path.isfile(os.path.join(input_spec, fname))]
-        elif os.path.isfile(input_spec):
-            file_list = [input_spec]
-        else:
-            file_list = glob.glob(input_spec)
-        return file_list
-
-    def create_context(self, cfg, output_path):
+    def create_context(self, cfg):
         vis_specs = self.visualizations
         visualizers = []
         extractors = []
@@ -82,7 +69,6 @@ class DensePose:
         context = {
             "extractor": extractor,
             "visualizer": visualizer,
-            "out_fname": output_path,
             "entry_idx": 0,
         }
         return context
@@ -99,59 +85,107 @@ class DensePose:
         x, y, w, h = [int(_) for _ in box[0].cpu().numpy()]
         i_array = data[0].labels[None].cpu().numpy()[0]
         result[y:y + h, x:x + w] = i_array
-        result = Image.fromarray(result)
-        result.save(context["out_fname"])
+        return result
 
-    def __call__(self, image_or_path, resize=512) -> Image.Image:
+    @staticmethod
+    def _load_bgr(image_or_path):
         """
-        :param image_or_path: Path of the input image.
-        :param resize: Resize the input image if its max size is larger than this value.
-        :return: Dense pose image.
+        :return: BGR image and the (width, height) the label map should be returned at.
         """
-        # random tmp path with timestamp
-        tmp_path = f"./densepose_/tmp/"
-        if not os.path.exists(tmp_path):
-            os.makedirs(tmp_path)
-
-        image_path = os.path.join(tmp_path, f"{int(time.time())}-{self.device}-{randint(0, 100000)}.png")
         if isinstance(image_or_path, str):
             assert image_or_path.split(".")[-1] in ["jpg", "png"], "Only support jpg and png images."
-            shutil.copy(image_or_path, image_path)
+            return read_image(image_or_path, format="BGR"), Image.open(image_or_path).size
         elif isinstance(image_or_path, Image.Image):
-            image_or_path.save(image_path)
-        else:
-            shutil.rmtree(tmp_path)
-            raise TypeError("image_path must be str or PIL.Image.Image")
-
-        output_path = image_path.replace(".png", "_dense.png").replace(".jpg", "_dense.png")
-        w, h = Image.open(image_path).size
-
-        file_list = self._get_input_file_list(image_path)
-        assert len(file_list), "No input images found!"
-        context = self.create_context(self.cfg, output_path)
-        for file_name in file_list:
-            img = read_image(file_name, format="BGR")  # predictor expects BGR image.
-            # resize
+            return np.ascontiguousarray(np.array(image_or_path.convert("RGB"))[:, :, ::-1]), image_or_path.size
+        elif isinstance(image_or_path, np.ndarray):
+            # numpy arrays are expected in RGB order, like np.array(PIL.Image)
+            return np.ascontiguousarray(image_or_path[:, :, ::-1]), (image_or_path.shape[1], image_or_path.shape[0])
+        raise TypeError("image_or_path must be str, PIL.Image.Image or np.ndarray")
+
+    def predict(self, image_or_path, resize=512) -> np.ndarray:
+        """
+        In-memory DensePose segmentation, no filesystem I/O besides reading `image_or_path` when it is a path.
+        Safe to call from several threads sharing one predictor.
+
+        :param image_or_path: Path of the input image, PIL image or RGB numpy array.
+        :param resize: Resize the input image if its max size is larger than this value.
+        :return: uint8 label map with the size of the input image.
+        """
+        img, (w, h) = self._load_bgr(image_or_path)  # predictor expects BGR image.
+        # resize
+        if (_ := max(img.shape)) > resize:
+            scale = resize / _
+            img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
+
+        with torch.no_grad():
+            outputs = self.predictor(img)["instances"]
+        try:
+            result = self.execute_on_outputs(self.context, {"image": img}, outputs)
+        except Exception as e:
+            # no person detected
+            return np.zeros((h, w), dtype=np.uint8)
+        if result.shape != (h, w):
+            result = np.array(Image.fromarray(result).resize((w, h), Image.NEAREST))
+        return result
+
+    def _model_input(self, img: np.ndarray) -> dict:
+        # Same pre-processing as `DefaultPredictor.__call__`, without running the model
+        if self.predictor.input_format == "RGB":
+            img = img[:, :, ::-1]
+        height, width = img.shape[:2]
+        image = self.predictor.aug.get_transform(img).apply_image(img)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def predict_batch(self, images_or_paths, resize=512, batch_size=8):
+        """
+        Batched DensePose segmentation. Images are bucketed by aspect ratio so each model call pads a batch of
+        similarly shaped images into one `ImageList`, then the R50-FPN RCNN runs once per bucket.
+
+        :param images_or_paths: List of paths, PIL images or RGB numpy arrays.
+        :param resize: Resize the input images if their max size is larger than this value.
+        :param batch_size: Maximum number of images per model call.
+        :return: List of uint8 label maps, in input order.
+        """
+        imgs, sizes = [], []
+        for image_or_path in images_or_paths:
+            img, size = self._load_bgr(image_or_path)
             if (_ := max(img.shape)) > resize:
                 scale = resize / _
                 img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
-
+            imgs.append(img)
+            sizes.append(size)
+
+        # bucket by aspect ratio to limit padding inside each ImageList
+        order = sorted(range(len(imgs)), key=lambda i: imgs[i].shape[0] / imgs[i].shape[1])
+        results = [None] * len(imgs)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
             with torch.no_grad():
-                outputs = self.predictor(img)["instances"]
+                outputs = self.predictor.model([self._model_input(imgs[i]) for i in indices])
+            for i, output in zip(indices, outputs):
+                w, h = sizes[i]
                 try:
-                    self.execute_on_outputs(context, {"file_name": file_name, "image": img}, outputs)
+                    result = self.execute_on_outputs(self.context, {"image": imgs[i]}, output["instances"])
                 except Exception as e:
-                    null_gray = Image.new('L', (1, 1))
-                    null_gray.save(output_path)
-
-        dense_gray = Image.open(output_path).convert("L")
-        dense_gray = dense_gray.resize((w, h), Image.NEAREST)
-        # remove image_path and output_path
-        os.remove(image_path)
-        os.remove(output_path)
-
-
-        return dense_gray
+                    # no person detected
+                    results[i] = np.zeros((h, w), dtype=np.uint8)
+                    continue
+                if result.shape != (h, w):
+                    result = np.array(Image.fromarray(result).resize((w, h), Image.NEAREST))
+                results[i] = result
+        return results
+
+    def __call__(self, image_or_path, resize=512, batch_size=8):
+        """
+        :param image_or_path: Path of the input image, PIL image or RGB numpy array, or a list of them.
+        :param resize: Resize the input image if its max size is larger than this value.
+        :param batch_size: Maximum number of images per model call when a list is given.
+        :return: Dense pose image, or a list of them for list input.
+        """
+        if isinstance(image_or_path, list):
+            return [Image.fromarray(result) for result in self.predict_batch(image_or_path, resize, batch_size)]
+        return Image.fromarray(self.predict(image_or_path, resize=resize))
 
 
 if __name__ == '__main__':
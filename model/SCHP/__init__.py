@@ -1,5 +1,5 @@
 from model.SCHP import networks
-from model.SCHP.utils.transforms import get_affine_transform, transform_logits
+from model.SCHP.utils.transforms import get_affine_transform, transform_logits_to_labels
 
 from collections import OrderedDict
 import torch
@@ -103,37 +103,44 @@ class SCHP:
                 new_state_dict_[k] = v
         self.model.load_state_dict(new_state_dict_, strict=False)
 
-    def _box2cs(self, box):
+    def _box2cs(self, box, aspect_ratio=None):
         x, y, w, h = box[:4]
-        return self._xywh2cs(x, y, w, h)
+        return self._xywh2cs(x, y, w, h, aspect_ratio)
 
-    def _xywh2cs(self, x, y, w, h):
+    def _xywh2cs(self, x, y, w, h, aspect_ratio=None):
+        aspect_ratio = self.aspect_ratio if aspect_ratio is None else aspect_ratio
         center = np.zeros((2), dtype=np.float32)
         center[0] = x + w * 0.5
         center[1] = y + h * 0.5
-        if w > self.aspect_ratio * h:
-            h = w * 1.0 / self.aspect_ratio
-        elif w < self.aspect_ratio * h:
-            w = h * self.aspect_ratio
+        if w > aspect_ratio * h:
+            h = w * 1.0 / aspect_ratio
+        elif w < aspect_ratio * h:
+            w = h * aspect_ratio
         scale = np.array([w, h], dtype=np.float32)
         return center, scale
 
-    def preprocess(self, image):
+    @staticmethod
+    def load_image(image):
         if isinstance(image, str):
-            img = cv2.imread(image, cv2.IMREAD_COLOR)
+            return cv2.imread(image, cv2.IMREAD_COLOR)
         elif isinstance(image, Image.Image):
             # to cv2 format
-            img = np.array(image)
+            return np.array(image)
+        return image
+
+    def preprocess(self, image, input_size=None):
+        input_size = self.input_size if input_size is None else input_size
+        img = self.load_image(image)
     
         h, w, _ = img.shape
         # Get person center and scale
-        person_center, s = self._box2cs([0, 0, w - 1, h - 1])
+        person_center, s = self._box2cs([0, 0, w - 1, h - 1], input_size[1] * 1.0 / input_size[0])
         r = 0
-        trans = get_affine_transform(person_center, s, r, self.input_size)
+        trans = get_affine_transform(person_center, s, r, input_size)
         input = cv2.warpAffine(
             img,
             trans,
-            (int(self.input_size[1]), int(self.input_size[0])),
+            (int(input_size[1]), int(input_size[0])),
             flags=cv2.INTER_LINEAR,
             borderMode=cv2.BORDER_CONSTANT,
             borderValue=(0, 0, 0))
@@ -144,36 +151,100 @@ class SCHP:
                 'height': h,
                 'width': w,
                 'scale': s,
-                'rotation': r
+                'rotation': r,
+                'input_size': input_size,
         }
         return input, meta
 
+    def preprocess_batch(self, image_or_path, input_size=None):
+        images = image_or_path if isinstance(image_or_path, list) else [image_or_path]
+        image_list = []
+        meta_list = []
+        for image in images:
+            image, meta = self.preprocess(image, input_size)
+            image_list.append(image)
+            meta_list.append(meta)
+        return torch.cat(image_list, dim=0), meta_list
 
-    def __call__(self, image_or_path):
-        if isinstance(image_or_path, list):
-            image_list = []
-            meta_list = []
-            for image in image_or_path:
-                image, meta = self.preprocess(image)
-                image_list.append(image)
-                meta_list.append(meta)
-            image = torch.cat(image_list, dim=0)
-        else:
-            image, meta = self.preprocess(image_or_path)
-            meta_list = [meta]
-                
+    @torch.no_grad()
+    def parse(self, image, meta_list):
+        """
+        Run the network on a preprocessed batch and return uint8 label maps (still on device).
+        """
         output = self.model(image)
         # upsample_outputs = self.upsample(output[0][-1])
-        upsample_outputs = self.upsample(output)
-        upsample_outputs = upsample_outputs.permute(0, 2, 3, 1)  # BCHW -> BHWC
+        upsample_outputs = torch.nn.functional.interpolate(output, size=image.shape[-2:], mode='bilinear', align_corners=True)
 
-        output_img_list = []
+        parsing_results = []
         for upsample_output, meta in zip(upsample_outputs, meta_list):
             c, s, w, h = meta['center'], meta['scale'], meta['width'], meta['height']
-            logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=self.input_size)
-            parsing_result = np.argmax(logits_result, axis=2)
-            output_img = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
+            # warp back and argmax on device, only the uint8 labels cross to host
+            parsing_results.append(transform_logits_to_labels(upsample_output, c, s, w, h, input_size=meta['input_size']))
+        return parsing_results
+
+    def to_images(self, parsing_results):
+        output_img_list = []
+        for parsing_result in parsing_results:
+            output_img = Image.fromarray(parsing_result.cpu().numpy())
             output_img.putpalette(self.palette)
             output_img_list.append(output_img)
+        return output_img_list[0] if len(output_img_list) == 1 else output_img_list
+
+    @torch.no_grad()
+    def __call__(self, image_or_path):
+        image, meta_list = self.preprocess_batch(image_or_path)
+        return self.to_images(self.parse(image, meta_list))
+
 
-        return output_img_list[0] if len(output_img_list) == 1 else output_img_list
\ No newline at end of file
+class SCHPPair:
+    """
+    Runs two SCHP parsers (ATR and LIP in `AutoMasker`) over the same images in one call.
+
+    Each image is decoded once for both models, and the two forwards run concurrently: on separate CUDA streams
+    on GPU, or on two threads of a small pool on CPU (ATen releases the GIL, so the convolutions overlap).
+    When both models use the same input size, or `fused_input_size` forces one, the warp/normalize is done once
+    and the same input batch feeds both models.
+    """
+
+    def __init__(self, first: SCHP, second: SCHP, fused_input_size=None):
+        self.first = first
+        self.second = second
+        self.fused_input_size = fused_input_size
+        if fused_input_size is None and list(first.input_size) == list(second.input_size):
+            self.fused_input_size = first.input_size
+        self._executor = None
+
+    def _run_concurrently(self, jobs):
+        device = torch.device(self.first.device)
+        if device.type == 'cuda':
+            current_stream = torch.cuda.current_stream(device)
+            results = []
+            for model, image, meta_list in jobs:
+                stream = torch.cuda.Stream(device)
+                stream.wait_stream(current_stream)
+                with torch.cuda.stream(stream):
+                    image.record_stream(stream)
+                    results.append((stream, model.parse(image, meta_list)))
+            for stream, _ in results:
+                current_stream.wait_stream(stream)
+            return [parsing_results for _, parsing_results in results]
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="schp")
+        futures = [self._executor.submit(model.parse, image, meta_list) for model, image, meta_list in jobs]
+        return [future.result() for future in futures]
+
+    @torch.no_grad()
+    def __call__(self, image_or_path):
+        """
+        :return: (first parsing, second parsing), each a PIL image or a list of them for list input.
+        """
+        images = image_or_path if isinstance(image_or_path, list) else [image_or_path]
+        images = [SCHP.load_image(image) for image in images]  # decode once for both models
+        if self.fused_input_size is not None:
+            image, meta_list = self.first.preprocess_batch(images, self.fused_input_size)
+            jobs = [(self.first, image, meta_list), (self.second, image, meta_list)]
+        else:
+            jobs = [(model, *model.preprocess_batch(images)) for model in (self.first, self.second)]
+        first_results, second_results = self._run_concurrently(jobs)
+        return self.first.to_images(first_results), self.second.to_images(second_results)
\ No newline at end of file
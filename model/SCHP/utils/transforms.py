@@ -96,6 +96,32 @@ def transform_logits(logits, center, scale, width, height, input_size):
 
     return target_logits
 
+def transform_logits_to_labels(logits, center, scale, width, height, input_size):
+    """
+    On-device equivalent of `transform_logits` followed by an argmax over classes.
+
+    logits: torch.Tensor(num_classes, input_h, input_w) on any device
+    Returns a torch.uint8 label map of shape (height, width) on the same device, so only the labels have to be
+    copied to host.
+    """
+    # `transform_logits` warps with the inverse transform, i.e. each output pixel samples the network input at
+    # forward_trans @ [x, y, 1]. Compose that with the pixel <-> normalized coordinate maps of `grid_sample`
+    # (align_corners=True puts -1 / +1 on the first / last pixel centers, like cv2's integer pixel grid).
+    forward_trans = np.vstack([get_affine_transform(center, scale, 0, input_size), [0, 0, 1]])
+    in_h, in_w = logits.shape[-2:]
+    to_input_norm = np.array([[2 / max(in_w - 1, 1), 0, -1], [0, 2 / max(in_h - 1, 1), -1], [0, 0, 1]])
+    from_output_norm = np.array([[max(width - 1, 1) / 2, 0, max(width - 1, 1) / 2],
+                                 [0, max(height - 1, 1) / 2, max(height - 1, 1) / 2],
+                                 [0, 0, 1]])
+    theta = (to_input_norm @ forward_trans @ from_output_norm)[:2]
+    theta = torch.from_numpy(theta).to(device=logits.device, dtype=torch.float32).unsqueeze(0)
+
+    logits = logits.unsqueeze(0).float()
+    grid = torch.nn.functional.affine_grid(theta, (1, logits.shape[1], int(height), int(width)), align_corners=True)
+    target_logits = torch.nn.functional.grid_sample(
+        logits, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    return target_logits[0].argmax(dim=0).to(torch.uint8)
+
 
 def get_affine_transform(center,
                          scale,
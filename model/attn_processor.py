@@ -110,4 +110,144 @@ class AttnProcessor2_0(torch.nn.Module):
         hidden_states = hidden_states / attn.rescale_output_factor
 
         return hidden_states
-   
\ No newline at end of file
+   
+class GarmentKVCacheState:
+    """
+    Refresh schedule shared by all `CachedKVAttnProcessor2_0` of one UNet.
+
+    Steps before `warmup_steps`, every `refresh_interval`-th step after that and the last `final_steps` steps run
+    full attention and refresh the caches; the others reuse them.
+    """
+
+    def __init__(self, refresh_interval: int = 3, warmup_steps: int = 5, final_steps: int = 2):
+        self.refresh_interval = refresh_interval
+        self.warmup_steps = warmup_steps
+        self.final_steps = final_steps
+        self.generation = 0
+        self.refresh = True
+        self.num_cached_steps = 0
+
+    def reset(self):
+        # invalidates every processor's cache, called once per pipeline call
+        self.generation += 1
+        self.refresh = True
+        self.num_cached_steps = 0
+
+    def begin_step(self, step: int, num_steps: int):
+        self.refresh = (
+            step < self.warmup_steps
+            or step >= num_steps - self.final_steps
+            or (step - self.warmup_steps) % self.refresh_interval == 0
+        )
+        self.num_cached_steps += not self.refresh
+
+
+class CachedKVAttnProcessor2_0(AttnProcessor2_0):
+    r"""
+    Approximate self-attention for CatVTON that reuses the garment half of the sequence across timesteps.
+
+    The garment latent is concatenated below the person along height, so the second half of the flattened token
+    sequence is garment tokens. On refresh steps this runs full attention and keeps the garment keys/values and the
+    garment output. On the other steps only the person tokens are projected and attend over [person K/V, cached
+    garment K/V], and the garment output is taken from the cache, which halves the attention cost. If the cached
+    batch is larger than the current one (e.g. cond-only steps of a CFG batch), its last rows are used.
+    """
+
+    def __init__(self, state: GarmentKVCacheState = None, hidden_size=None, cross_attention_dim=None, **kwargs):
+        super().__init__(hidden_size=hidden_size, cross_attention_dim=cross_attention_dim, **kwargs)
+        self.state = state if state is not None else GarmentKVCacheState()
+        self.generation = None
+        self.cached_key = None
+        self.cached_value = None
+        self.cached_output = None
+
+    def _cached(self, tensor, batch_size):
+        if tensor.shape[0] == batch_size:
+            return tensor
+        return tensor[-batch_size:]
+
+    def __call__(
+        self,
+        attn,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+        *args,
+        **kwargs,
+    ):
+        if encoder_hidden_states is not None or attention_mask is not None:
+            # not a plain self-attention call, nothing to cache
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb, *args, **kwargs)
+
+        batch_size = hidden_states.shape[0]
+        use_cache = (
+            not self.state.refresh
+            and self.generation == self.state.generation
+            and self.cached_key is not None
+            and self.cached_key.shape[0] >= batch_size
+        )
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        sequence_length = hidden_states.shape[1]
+        person_length = sequence_length // 2
+        if use_cache:
+            hidden_states = hidden_states[:, :person_length]
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if use_cache:
+            key = torch.cat([key, self._cached(self.cached_key, batch_size)], dim=2)
+            value = torch.cat([value, self._cached(self.cached_value, batch_size)], dim=2)
+        else:
+            self.cached_key = key[:, :, person_length:].clone()
+            self.cached_value = value[:, :, person_length:].clone()
+            self.generation = self.state.generation
+
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False
+        )
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if use_cache:
+            hidden_states = torch.cat([hidden_states, self._cached(self.cached_output, batch_size)], dim=1)
+        else:
+            self.cached_output = hidden_states[:, person_length:].clone()
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
@@ -0,0 +1,338 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from safetensors.torch import load_file, save_file
+
+
+def content_hash(obj) -> str:
+    """
+    Hash the pixel content of an image-like object (PIL image, numpy array, tensor or file path).
+    """
+    sha = hashlib.sha1()
+    if isinstance(obj, str):
+        with open(obj, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+    elif isinstance(obj, Image.Image):
+        sha.update(f"{obj.mode}:{obj.size}".encode())
+        sha.update(obj.tobytes())
+    elif isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().contiguous()
+        sha.update(f"{obj.dtype}:{tuple(obj.shape)}".encode())
+        sha.update(obj.view(torch.uint8).numpy().tobytes() if obj.dtype == torch.bfloat16 else obj.numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        sha.update(f"{obj.dtype}:{obj.shape}".encode())
+        sha.update(obj.tobytes())
+    else:
+        raise TypeError(f"Cannot hash object of type {type(obj)}")
+    return sha.hexdigest()
+
+
+def module_identity(module: torch.nn.Module) -> str:
+    """
+    A short string identifying a loaded model: class, checkpoint name and dtype.
+    """
+    module = getattr(module, "_orig_mod", module)  # unwrap torch.compile
+    config = getattr(module, "config", None)
+    name_or_path = getattr(config, "_name_or_path", "") if config is not None else ""
+    dtype = getattr(module, "dtype", None)
+    return f"{module.__class__.__name__}:{name_or_path}:{dtype}"
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache bounded by the total size of its values in bytes.
+
+    If `cache_dir` is given, entries are also written through to disk and looked up there on an in-memory miss,
+    so the cache survives restarts and can be shared between processes. `max_bytes` only bounds the in-memory
+    entries: the directory is bounded by `max_disk_bytes`, past which the least recently used files (by
+    modification time, refreshed on disk hits) are deleted. With `max_disk_bytes=None` it grows without limit.
+    Subclasses define how values are sized, saved and loaded.
+    """
+
+    suffix = ".bin"
+
+    def __init__(self, max_bytes: int = 1 << 30, cache_dir: Optional[str] = None, max_disk_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            if max_disk_bytes is not None:
+                self._prune_disk()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def sizeof(self, value) -> int:
+        raise NotImplementedError
+
+    def save(self, path: str, value):
+        raise NotImplementedError
+
+    def load(self, path: str):
+        raise NotImplementedError
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def _disk_files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _prune_disk(self):
+        # rescans the directory, since other processes may share it; only called once the running total is over budget
+        with self._disk_lock:
+            files = self._disk_files()
+            self.disk_bytes = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if self.disk_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.disk_bytes -= size
+
+    def _insert(self, key: str, value):
+        # caller holds the lock
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.current_bytes -= self.sizeof(self._entries.pop(key))
+        self._entries[key] = value
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= self.sizeof(evicted)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.cache_dir is not None and os.path.exists(path := self._path(key)):
+            try:
+                value = self.load(path)
+                if self.max_disk_bytes is not None:
+                    os.utime(path)  # recently used, so it is evicted last
+            except Exception as e:
+                print(f"Failed to load cache entry {path}: {e}")
+            else:
+                with self._lock:
+                    self._insert(key, value)
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._insert(key, value)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a private temp file then rename, so concurrent readers never see a partial entry
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            self.save(tmp_path, value)
+            os.replace(tmp_path, path)
+            if self.max_disk_bytes is not None:
+                with self._disk_lock:
+                    self.disk_bytes += os.path.getsize(path)
+                    over_budget = self.disk_bytes > self.max_disk_bytes
+                if over_budget:
+                    self._prune_disk()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.cache_dir is not None and os.path.exists(self._path(key))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class GarmentLatentCache(LRUCache):
+    """
+    Cache of VAE latent distributions for garment (condition) images.
+
+    Values are the `latent_dist.parameters` tensors (mean and logvar concatenated on the channel axis) of one image,
+    so a hit skips the VAE encoder while sampling still behaves exactly like a fresh encode. The on-disk store keeps
+    one float32 `.npy` per entry and opens it memory-mapped. In-memory entries are the tensors as encoded (usually on
+    the VAE's device), so `max_bytes` bounds GPU memory in that case.
+    """
+
+    suffix = ".npy"
+
+    def __init__(
+        self,
+        max_bytes: int = 1 << 30,
+        cache_dir: Optional[str] = None,
+        device=None,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        super().__init__(max_bytes=max_bytes, cache_dir=cache_dir, max_disk_bytes=max_disk_bytes)
+        self.device = device
+
+    @staticmethod
+    def make_key(image, vae: torch.nn.Module, height: int, width: int) -> str:
+        return hashlib.sha1(
+            f"{content_hash(image)}:{height}x{width}:{module_identity(vae)}".encode()
+        ).hexdigest()
+
+    @classmethod
+    def make_keys(cls, images, vae: torch.nn.Module, height: int, width: int):
+        """
+        One key per garment for a single image, a list of images or a batched tensor.
+        """
+        if isinstance(images, torch.Tensor):
+            images = list(images) if images.ndim == 4 else [images]
+        elif not isinstance(images, (list, tuple)):
+            images = [images]
+        return [cls.make_key(image, vae, height, width) for image in images]
+
+    def sizeof(self, value: torch.Tensor) -> int:
+        return value.numel() * value.element_size()
+
+    def save(self, path: str, value: torch.Tensor):
+        with open(path, "wb") as f:
+            np.save(f, value.detach().float().cpu().numpy())
+
+    def load(self, path: str) -> torch.Tensor:
+        # copy-on-write mapping: the tensor shares the mapped pages and is only read into memory when it is moved
+        # to `device` (or touched)
+        tensor = torch.from_numpy(np.load(path, mmap_mode="c"))
+        return tensor.to(self.device) if self.device is not None else tensor
+
+
+class ParsingCache(LRUCache):
+    """
+    Cache of person parsing maps (`densepose`, `schp_atr`, `schp_lip`) keyed by the content of the person image.
+
+    Values are dicts of uint8 label arrays, which keeps entries compact in memory; on disk each entry is one
+    compressed `.npz`. A hit lets `AutoMasker` skip all three CNN passes and only rebuild the agnostic mask.
+    """
+
+    suffix = ".npz"
+
+    @staticmethod
+    def make_key(image, identity: str = "") -> str:
+        return hashlib.sha1(f"{content_hash(image)}:{identity}".encode()).hexdigest()
+
+    def sizeof(self, value: dict) -> int:
+        return sum(array.nbytes for array in value.values())
+
+    def save(self, path: str, value: dict):
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **value)
+
+    def load(self, path: str) -> dict:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+
+class PromptEmbedsCache(LRUCache):
+    """
+    Cache of text-encoder outputs for FLUX prompts (`prompt_embeds`, `pooled_prompt_embeds`, `text_ids`).
+
+    Keys are the whitespace-normalized prompt plus `max_sequence_length` and the encoder identity, so a repeated
+    prompt skips the CLIP/T5 forward (and loading them at all). On disk each entry is one `.safetensors` file.
+    """
+
+    suffix = ".safetensors"
+
+    def __init__(
+        self,
+        max_bytes: int = 256 << 20,
+        cache_dir: Optional[str] = None,
+        device=None,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        super().__init__(max_bytes=max_bytes, cache_dir=cache_dir, max_disk_bytes=max_disk_bytes)
+        self.device = device
+
+    @staticmethod
+    def make_key(prompt: str, max_sequence_length: int, identity: str = "") -> str:
+        prompt = " ".join(prompt.split())
+        return hashlib.sha1(f"{prompt}:{max_sequence_length}:{identity}".encode()).hexdigest()
+
+    def sizeof(self, value: dict) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in value.values())
+
+    def save(self, path: str, value: dict):
+        save_file({name: tensor.detach().cpu().contiguous() for name, tensor in value.items()}, path)
+
+    def load(self, path: str) -> dict:
+        return load_file(path, device=str(self.device) if self.device is not None else "cpu")
+
+
+class TextCache(LRUCache):
+    """
+    Cache of text responses (LLM garment descriptions and campaign captions) keyed by their inputs.
+
+    On disk each entry is one UTF-8 `.txt` file.
+    """
+
+    suffix = ".txt"
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha1("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+
+    def sizeof(self, value: str) -> int:
+        return len(value.encode())
+
+    def save(self, path: str, value: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(value)
+
+    def load(self, path: str) -> str:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
@@ -1,4 +1,5 @@
 import os
+import functools
 from PIL import Image
 from typing import Union
 import numpy as np
@@ -6,7 +7,8 @@ import cv2
 from diffusers.image_processor import VaeImageProcessor
 import torch
 
-from model.SCHP import SCHP  # type: ignore
+from model.cache import ParsingCache
+from model.SCHP import SCHP, SCHPPair  # type: ignore
 from model.DensePose import DensePose  # type: ignore
 
 DENSE_INDEX_MAP = {
@@ -127,8 +129,23 @@ def vis_mask(image, mask):
     mask = mask / 255
     return Image.fromarray((image * (1 - mask)).astype(np.uint8))
 
+def part_lut(part: Union[str, list], mapping: dict) -> np.ndarray:
+    """
+    Lookup table form of `part_mask_of`: `part_lut(part, mapping)[parse]` is the same mask for a uint8 label map.
+    """
+    if isinstance(part, str):
+        part = [part]
+    lut = np.zeros(256, dtype=np.uint8)
+    for _ in part:
+        if _ not in mapping:
+            continue
+        np.add.at(lut, mapping[_], 1)
+    return lut
+
 def part_mask_of(part: Union[str, list],
                  parse: np.ndarray, mapping: dict):
+    if parse.dtype == np.uint8:
+        return part_lut(part, mapping)[parse]
     if isinstance(part, str):
         part = [part]
     mask = np.zeros_like(parse)
@@ -142,6 +159,34 @@ def part_mask_of(part: Union[str, list],
             mask += (parse == mapping[_])
     return mask
 
+@functools.lru_cache(maxsize=None)
+def agnostic_mask_luts(part: str) -> dict:
+    """
+    The region algebra of `AutoMasker.cloth_agnostic_mask` for one mask type, with every union over labels of the
+    same map folded into a single lookup table, so each region costs one indexing pass over the label map.
+    """
+    limb_parts = ['Left-arm', 'Right-arm', 'Left-leg', 'Right-leg']
+    accessory_parts = ['Hat', 'Glove', 'Sunglasses', 'Bag', 'Left-shoe', 'Right-shoe', 'Scarf', 'Socks']
+    luts = {
+        'hands_dense': part_lut(['hands', 'feet'], DENSE_INDEX_MAP),
+        'limbs_atr': part_lut(limb_parts, ATR_MAPPING),
+        'limbs_lip': part_lut(limb_parts, LIP_MAPPING),
+        'face_lip': part_lut('Face', LIP_MAPPING),
+        # body | hair | irrelevant cloth | accessory, per map
+        'weak_lip': part_lut(PROTECT_BODY_PARTS[part], LIP_MAPPING) | part_lut(['Hair'], LIP_MAPPING) | \
+            part_lut(PROTECT_CLOTH_PARTS[part]['LIP'], LIP_MAPPING) | part_lut(accessory_parts, LIP_MAPPING),
+        'weak_atr': part_lut(PROTECT_BODY_PARTS[part], ATR_MAPPING) | part_lut(['Hair'], ATR_MAPPING) | \
+            part_lut(PROTECT_CLOTH_PARTS[part]['ATR'], ATR_MAPPING) | part_lut(accessory_parts, ATR_MAPPING),
+        'mask_lip': part_lut(MASK_CLOTH_PARTS[part], LIP_MAPPING),
+        'mask_atr': part_lut(MASK_CLOTH_PARTS[part], ATR_MAPPING),
+        'background_lip': part_lut(['Background'], LIP_MAPPING),
+        'background_atr': part_lut(['Background'], ATR_MAPPING),
+        'mask_dense': part_lut(MASK_DENSE_PARTS[part], DENSE_INDEX_MAP),
+    }
+    for lut in luts.values():
+        lut.flags.writeable = False  # shared between calls through the lru_cache
+    return luts
+
 def hull_mask(mask_area: np.ndarray):
     ret, binary = cv2.threshold(mask_area, 127, 255, cv2.THRESH_BINARY)
     contours, hierarchy = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -157,7 +202,8 @@ class AutoMasker:
         self, 
         densepose_ckpt='./Models/DensePose', 
         schp_ckpt='./Models/SCHP', 
-        device='cuda'):
+        device='cuda',
+        parsing_cache: ParsingCache = None):
         np.random.seed(0)
         torch.manual_seed(0)
         torch.cuda.manual_seed(0)
@@ -165,8 +211,13 @@ class AutoMasker:
         self.densepose_processor = DensePose(densepose_ckpt, device)
         self.schp_processor_atr = SCHP(ckpt_path=os.path.join(schp_ckpt, 'exp-schp-201908301523-atr.pth'), device=device)
         self.schp_processor_lip = SCHP(ckpt_path=os.path.join(schp_ckpt, 'exp-schp-201908261155-lip.pth'), device=device)
+        # decodes each person image once and runs ATR and LIP concurrently
+        self.schp_processor_pair = SCHPPair(self.schp_processor_atr, self.schp_processor_lip)
         
         self.mask_processor = VaeImageProcessor(vae_scale_factor=8, do_normalize=False, do_binarize=True, do_convert_grayscale=True)
+        # Optional content-addressed cache of the parsing maps, so a new mask_type on the same person skips the CNNs
+        self.parsing_cache = parsing_cache
+        self.parsing_identity = f"{densepose_ckpt}:{schp_ckpt}:1024"
 
     def process_densepose(self, image_or_path):
         return self.densepose_processor(image_or_path, resize=1024)
@@ -178,10 +229,57 @@ class AutoMasker:
         return self.schp_processor_atr(image_or_path)
         
     def preprocess_image(self, image_or_path):
+        if self.parsing_cache is None:
+            return self._run_parsers(image_or_path)
+        key = ParsingCache.make_key(image_or_path, self.parsing_identity)
+        cached = self.parsing_cache.get(key)
+        if cached is not None:
+            return self._parsing_from_arrays(cached)
+        results = self._run_parsers(image_or_path)
+        self.parsing_cache.put(key, {name: np.asarray(result, dtype=np.uint8) for name, result in results.items()})
+        return results
+
+    def preprocess_images(self, images_or_paths: list):
+        """
+        Batched `preprocess_image`: DensePose and both SCHP models each run once over all cache misses.
+        """
+        results = [None] * len(images_or_paths)
+        keys = [None] * len(images_or_paths)
+        if self.parsing_cache is not None:
+            for i, image_or_path in enumerate(images_or_paths):
+                keys[i] = ParsingCache.make_key(image_or_path, self.parsing_identity)
+                if (cached := self.parsing_cache.get(keys[i])) is not None:
+                    results[i] = self._parsing_from_arrays(cached)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            batch = [images_or_paths[i] for i in missing]
+            densepose = self.densepose_processor(batch, resize=1024)
+            schp_atr, schp_lip = self.schp_processor_pair(batch)
+            if len(batch) == 1:
+                schp_atr, schp_lip = [schp_atr], [schp_lip]
+            for j, i in enumerate(missing):
+                results[i] = {'densepose': densepose[j], 'schp_atr': schp_atr[j], 'schp_lip': schp_lip[j]}
+                if self.parsing_cache is not None:
+                    self.parsing_cache.put(keys[i], {name: np.asarray(result, dtype=np.uint8) for name, result in results[i].items()})
+        return results
+
+    def _run_parsers(self, image_or_path):
+        schp_atr, schp_lip = self.schp_processor_pair(image_or_path)
         return {
             'densepose': self.densepose_processor(image_or_path, resize=1024),
-            'schp_atr': self.schp_processor_atr(image_or_path),
-            'schp_lip': self.schp_processor_lip(image_or_path)
+            'schp_atr': schp_atr,
+            'schp_lip': schp_lip
+        }
+
+    def _parsing_from_arrays(self, arrays):
+        schp_atr = Image.fromarray(arrays['schp_atr'])
+        schp_atr.putpalette(self.schp_processor_atr.palette)
+        schp_lip = Image.fromarray(arrays['schp_lip'])
+        schp_lip.putpalette(self.schp_processor_lip.palette)
+        return {
+            'densepose': Image.fromarray(arrays['densepose']),
+            'schp_atr': schp_atr,
+            'schp_lip': schp_lip
         }
     
     @staticmethod
@@ -206,31 +304,24 @@ class AutoMasker:
         schp_lip_mask = np.array(schp_lip_mask)
         schp_atr_mask = np.array(schp_atr_mask)
         
+        luts = agnostic_mask_luts(part)
+        
         # Strong Protect Area (Hands, Face, Accessory, Feet)
-        hands_protect_area = part_mask_of(['hands', 'feet'], densepose_mask, DENSE_INDEX_MAP)
+        hands_protect_area = luts['hands_dense'][densepose_mask]
         hands_protect_area = cv2.dilate(hands_protect_area, dilate_kernel, iterations=1)
         hands_protect_area = hands_protect_area & \
-            (part_mask_of(['Left-arm', 'Right-arm', 'Left-leg', 'Right-leg'], schp_atr_mask, ATR_MAPPING) | \
-             part_mask_of(['Left-arm', 'Right-arm', 'Left-leg', 'Right-leg'], schp_lip_mask, LIP_MAPPING))
-        face_protect_area = part_mask_of('Face', schp_lip_mask, LIP_MAPPING)
+            (luts['limbs_atr'][schp_atr_mask] | luts['limbs_lip'][schp_lip_mask])
+        face_protect_area = luts['face_lip'][schp_lip_mask]
 
         strong_protect_area = hands_protect_area | face_protect_area 
 
-        # Weak Protect Area (Hair, Irrelevant Clothes, Body Parts)
-        body_protect_area = part_mask_of(PROTECT_BODY_PARTS[part], schp_lip_mask, LIP_MAPPING) | part_mask_of(PROTECT_BODY_PARTS[part], schp_atr_mask, ATR_MAPPING)
-        hair_protect_area = part_mask_of(['Hair'], schp_lip_mask, LIP_MAPPING) | \
-            part_mask_of(['Hair'], schp_atr_mask, ATR_MAPPING)
-        cloth_protect_area = part_mask_of(PROTECT_CLOTH_PARTS[part]['LIP'], schp_lip_mask, LIP_MAPPING) | \
-            part_mask_of(PROTECT_CLOTH_PARTS[part]['ATR'], schp_atr_mask, ATR_MAPPING)
-        accessory_protect_area = part_mask_of((accessory_parts := ['Hat', 'Glove', 'Sunglasses', 'Bag', 'Left-shoe', 'Right-shoe', 'Scarf', 'Socks']), schp_lip_mask, LIP_MAPPING) | \
-            part_mask_of(accessory_parts, schp_atr_mask, ATR_MAPPING) 
-        weak_protect_area = body_protect_area | cloth_protect_area | hair_protect_area | strong_protect_area | accessory_protect_area
+        # Weak Protect Area (Hair, Irrelevant Clothes, Body Parts, Accessory)
+        weak_protect_area = luts['weak_lip'][schp_lip_mask] | luts['weak_atr'][schp_atr_mask] | strong_protect_area
         
         # Mask Area
-        strong_mask_area = part_mask_of(MASK_CLOTH_PARTS[part], schp_lip_mask, LIP_MAPPING) | \
-            part_mask_of(MASK_CLOTH_PARTS[part], schp_atr_mask, ATR_MAPPING)
-        background_area = part_mask_of(['Background'], schp_lip_mask, LIP_MAPPING) & part_mask_of(['Background'], schp_atr_mask, ATR_MAPPING)
-        mask_dense_area = part_mask_of(MASK_DENSE_PARTS[part], densepose_mask, DENSE_INDEX_MAP)
+        strong_mask_area = luts['mask_lip'][schp_lip_mask] | luts['mask_atr'][schp_atr_mask]
+        background_area = luts['background_lip'][schp_lip_mask] & luts['background_atr'][schp_atr_mask]
+        mask_dense_area = luts['mask_dense'][densepose_mask]
         mask_dense_area = cv2.resize(mask_dense_area.astype(np.uint8), None, fx=0.25, fy=0.25, interpolation=cv2.INTER_NEAREST)
         mask_dense_area = cv2.dilate(mask_dense_area, dilate_kernel, iterations=2)
         mask_dense_area = cv2.resize(mask_dense_area.astype(np.uint8), None, fx=4, fy=4, interpolation=cv2.INTER_NEAREST)
@@ -268,6 +359,22 @@ class AutoMasker:
             'schp_atr': preprocess_results['schp_atr']
         }
 
+    def batch_call(self, images: list, mask_type: str = "upper"):
+        """
+        Batched `__call__` over a list of images (paths or PIL images) sharing one `mask_type`.
+        """
+        assert mask_type in ['upper', 'lower', 'overall', 'inner', 'outer'], f"mask_type should be one of ['upper', 'lower', 'overall', 'inner', 'outer'], but got {mask_type}"
+        outputs = []
+        for preprocess_results in self.preprocess_images(images):
+            mask = self.cloth_agnostic_mask(
+                preprocess_results['densepose'], 
+                preprocess_results['schp_lip'], 
+                preprocess_results['schp_atr'], 
+                part=mask_type,
+            )
+            outputs.append({'mask': mask, **preprocess_results})
+        return outputs
+
 
 if __name__ == '__main__':
     pass
@@ -1,8 +1,11 @@
 
-from typing import Any, Callable, Dict, List, Optional, Union
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from diffusers.image_processor import VaeImageProcessor
 from diffusers.loaders import (
     FluxLoraLoaderMixin,
@@ -21,10 +24,26 @@ from diffusers.schedulers import FlowMatchEulerDiscreteScheduler
 from diffusers.utils import logging
 from diffusers.utils.torch_utils import randn_tensor
 
+from model.cache import GarmentLatentCache
+from model.flux.sampling import flux_sigmas, get_sampler
 from model.flux.transformer_flux import FluxTransformer2DModel
+from utils import compute_cached_vae_encodings
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+
+@lru_cache(maxsize=16)
+def latent_image_ids(height: int, width: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Position ids `(0, row, col)` of a packed `height x width` latent grid, built once per resolution on `device`.
+    The tensor is shared between callers and must not be modified in place.
+    """
+    rows = torch.arange(height, device=device)[:, None].expand(height, width)
+    cols = torch.arange(width, device=device)[None, :].expand(height, width)
+    ids = torch.stack((torch.zeros_like(rows), rows, cols), dim=-1).reshape(height * width, 3)
+    return ids.to(dtype)
+
+
 # Modified from `diffusers.pipelines.flux.pipeline_flux_fill.FluxFillPipeline`
 class FluxTryOnPipeline(
     DiffusionPipeline,
@@ -64,6 +83,11 @@ class FluxTryOnPipeline(
             do_convert_grayscale=True,
         )
         self.default_sample_size = 128
+        self.latent_cache = None
+        # TryOnEdit: per-resolution rotary tables and per-schedule time embeddings, reused across steps and requests
+        self._rotary_cache = OrderedDict()
+        self._temb_cache = OrderedDict()
+        self.embedding_cache_size = 8
         
         self.transformer.remove_text_layers() # TryOnEdit: remove text layers
     
@@ -87,6 +111,8 @@ class FluxTryOnPipeline(
         dtype,
         device,
         generator,
+        condition_image=None,
+        condition_cache_keys=None,
     ):
         # 1. calculate the height and width of the latents
         # VAE applies 8x compression on images but we must also account for packing which requires
@@ -95,8 +121,21 @@ class FluxTryOnPipeline(
         width = 2 * (int(width) // (self.vae_scale_factor * 2))
 
         # 2. encode the masked image
+        # TryOnEdit: the images are not yet repeated per prompt, so each one is sampled with the generator of its
+        # first output
+        if isinstance(generator, list):
+            generator = generator[::num_images_per_prompt]
         if masked_image.shape[1] == num_channels_latents:
             masked_image_latents = masked_image
+        elif condition_image is not None:
+            # TryOnEdit: person and garment are encoded separately so the garment latents can come from the cache,
+            # then concatenated along width. This only approximates encoding the concatenated image: the encoder's
+            # mid-block attention and its convolutions see across the seam, so the latents differ everywhere
+            masked_image_latents = retrieve_latents(self.vae.encode(masked_image), generator=generator)
+            condition_latents = compute_cached_vae_encodings(
+                condition_image, self.vae, self.latent_cache, condition_cache_keys, generator=generator
+            )
+            masked_image_latents = torch.cat((masked_image_latents, condition_latents.to(masked_image_latents.dtype)), dim=-1)
         else:
             masked_image_latents = retrieve_latents(self.vae.encode(masked_image), generator=generator)
 
@@ -112,7 +151,9 @@ class FluxTryOnPipeline(
                     f" a total batch size of {batch_size}, but {mask.shape[0]} masks were passed. Make sure the number"
                     " of masks that you pass is divisible by the total requested batch size."
                 )
-            mask = mask.repeat(batch_size // mask.shape[0], 1, 1, 1)
+            # TryOnEdit: repeat each item in place, so the outputs of one input stay adjacent and line up with the
+            # per-sample generators
+            mask = mask.repeat_interleave(batch_size // mask.shape[0], dim=0)
         if masked_image_latents.shape[0] < batch_size:
             if not batch_size % masked_image_latents.shape[0] == 0:
                 raise ValueError(
@@ -120,7 +161,7 @@ class FluxTryOnPipeline(
                     f" to a total batch size of {batch_size}, but {masked_image_latents.shape[0]} images were passed."
                     " Make sure the number of images that you pass is divisible by the total requested batch size."
                 )
-            masked_image_latents = masked_image_latents.repeat(batch_size // masked_image_latents.shape[0], 1, 1, 1)
+            masked_image_latents = masked_image_latents.repeat_interleave(batch_size // masked_image_latents.shape[0], dim=0)
 
         # 4. pack the masked_image_latents
         # batch_size, num_channels_latents, height, width -> batch_size, height//2 * width//2 , num_channels_latents*4
@@ -192,20 +233,103 @@ class FluxTryOnPipeline(
         if condition_image is None:
             raise ValueError("Please provide `condition_image`.")
 
+        # TryOnEdit: batched calls take one person, garment and mask per sample
+        if image is not None:
+            counts = [self._num_images(x) for x in (image, condition_image, mask_image)]
+            if len(set(counts)) != 1:
+                raise ValueError(
+                    f"`image`, `condition_image` and `mask_image` must have the same number of samples, but got {counts}."
+                )
+
+    @staticmethod
+    def _num_images(image) -> int:
+        if isinstance(image, (list, tuple)):
+            return len(image)
+        if isinstance(image, (torch.Tensor, np.ndarray)) and image.ndim == 4:
+            return image.shape[0]
+        return 1
+
     @staticmethod
-    # Copied from diffusers.pipelines.flux.pipeline_flux.FluxPipeline._prepare_latent_image_ids
+    # Modified from diffusers.pipelines.flux.pipeline_flux.FluxPipeline._prepare_latent_image_ids
     def _prepare_latent_image_ids(batch_size, height, width, device, dtype):
-        latent_image_ids = torch.zeros(height, width, 3)
-        latent_image_ids[..., 1] = latent_image_ids[..., 1] + torch.arange(height)[:, None]
-        latent_image_ids[..., 2] = latent_image_ids[..., 2] + torch.arange(width)[None, :]
+        # TryOnEdit: cached per resolution on the device instead of rebuilt on CPU for every request
+        return latent_image_ids(height, width, torch.device(device), dtype)
+
+    def _cached(self, cache: OrderedDict, key, compute):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = cache[key] = compute()
+        while len(cache) > self.embedding_cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def rotary_embedding(self, height: int, width: int, device, dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""
+        The transformer's rotary `(cos, sin)` tables for a packed `height x width` latent grid, cached on `device`.
+        """
+        return self._cached(
+            self._rotary_cache,
+            (height, width, str(device), dtype),
+            lambda: self.transformer.pos_embed(latent_image_ids(height, width, torch.device(device), dtype)),
+        )
 
-        latent_image_id_height, latent_image_id_width, latent_image_id_channels = latent_image_ids.shape
+    @staticmethod
+    def _is_offloaded(module: torch.nn.Module) -> bool:
+        # model / sequential CPU offload attach accelerate hooks to the module or its submodules
+        return any(hasattr(submodule, "_hf_hook") for submodule in module.modules())
 
-        latent_image_ids = latent_image_ids.reshape(
-            latent_image_id_height * latent_image_id_width, latent_image_id_channels
-        )
+    def time_embeddings(self, timesteps: torch.Tensor, guidance_scale: float, dtype) -> torch.Tensor:
+        r"""
+        The transformer's timestep (and guidance) embedding for every step of `timesteps`, one row per step, cached
+        per schedule. The pooled projection input is the constant zero vector the try-on pipeline always passes.
+        Cleared by every LoRA method that changes the effective weights (load / unload, adapter selection and
+        deletion, enable / disable, fuse / unfuse), since LoRA may adapt the embedding layers. Runs the embedding
+        layers outside `transformer.forward`, so it must not be used while the transformer is CPU offloaded.
+        """
+        guidance_embeds = self.transformer.config.guidance_embeds
+
+        def compute():
+            # same rounding as the per-step `t.to(latents.dtype) / 1000` passed to the transformer
+            timestep = timesteps.to(dtype) / 1000
+            guidance = torch.full_like(timestep, guidance_scale, dtype=torch.float32) if guidance_embeds else None
+            pooled_projections = torch.zeros([len(timesteps), 768], device=timesteps.device, dtype=dtype)
+            return self.transformer.time_embedding(timestep, guidance, pooled_projections, dtype)
+
+        key = (tuple(timesteps.tolist()), guidance_scale if guidance_embeds else None, str(timesteps.device), dtype)
+        return self._cached(self._temb_cache, key, compute)
+
+    def load_lora_weights(self, *args, **kwargs):
+        super().load_lora_weights(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def unload_lora_weights(self, *args, **kwargs):
+        super().unload_lora_weights(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def set_adapters(self, *args, **kwargs):
+        super().set_adapters(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def delete_adapters(self, *args, **kwargs):
+        super().delete_adapters(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def enable_lora(self, *args, **kwargs):
+        super().enable_lora(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def disable_lora(self, *args, **kwargs):
+        super().disable_lora(*args, **kwargs)
+        self._temb_cache.clear()
 
-        return latent_image_ids.to(device=device, dtype=dtype)
+    def fuse_lora(self, *args, **kwargs):
+        super().fuse_lora(*args, **kwargs)
+        self._temb_cache.clear()
+
+    def unfuse_lora(self, *args, **kwargs):
+        super().unfuse_lora(*args, **kwargs)
+        self._temb_cache.clear()
 
     @staticmethod
     # Copied from diffusers.pipelines.flux.pipeline_flux.FluxPipeline._pack_latents
@@ -262,6 +386,60 @@ class FluxTryOnPipeline(
         """
         self.vae.disable_tiling()
 
+    def enable_latent_cache(self, cache: GarmentLatentCache):
+        r"""
+        Enable the garment latent cache. Garments are then VAE-encoded separately from the masked person and looked
+        up in `cache` first, so repeated garments skip the encoder.
+
+        This is an approximation for FLUX try-on: the LoRA was trained on latents of the concatenated person | garment
+        image, and the VAE encoder mixes information across the seam (global mid-block attention, overlapping
+        convolutions), so separately encoded latents differ everywhere and outputs change. Garment latents of a
+        concatenated encode depend on the person, so they cannot be cached. Unlike CatVTON, which encodes person and
+        garment separately by design, the exact path here is the default one without a cache.
+        """
+        logger.warning(
+            "The garment latent cache encodes person and garment separately, which approximates the concatenated "
+            "encode FLUX try-on was trained on; outputs will differ from the uncached pipeline."
+        )
+        self.latent_cache = cache
+
+    def disable_latent_cache(self):
+        r"""
+        Disable the garment latent cache and go back to encoding the concatenated person and garment in one pass.
+        """
+        self.latent_cache = None
+
+    def enable_first_block_cache(self, threshold: float = 0.08):
+        r"""
+        Enable the transformer's first-block cache: steps whose first-block residual changed by less than `threshold`
+        (relative L1) reuse the output of the remaining blocks from the last fully computed step. Higher thresholds
+        skip more steps at more quality cost; `num_skipped_steps` reports how many the last call skipped.
+        """
+        self.transformer.enable_first_block_cache(threshold)
+
+    def disable_first_block_cache(self):
+        r"""
+        Disable the first-block cache and go back to running every block on every step.
+        """
+        self.transformer.disable_first_block_cache()
+
+    def garment_token_index(self, condition_image: torch.Tensor, threshold: float = 0.94) -> torch.Tensor:
+        r"""
+        Indices of the packed tokens kept by garment-token pruning: every person token, plus each garment token whose
+        16x16 pixel patch has a pixel darker than `threshold` (in [-1, 1]) in some sample of the batch. The kept set is
+        dilated by one token so garment edges keep their surroundings. Near-white tokens, mostly the padding added by
+        `resize_and_padding`, are dropped.
+        """
+        patch = self.vae_scale_factor * 2
+        rows, cols = condition_image.shape[-2] // patch, condition_image.shape[-1] // patch
+        darkest = condition_image[..., : rows * patch, : cols * patch].float().amin(dim=1, keepdim=True)
+        darkest = -F.max_pool2d(-darkest, patch)
+        keep = F.max_pool2d((darkest < threshold).float(), 3, stride=1, padding=1).amax(dim=(0, 1)).bool()
+        # packed tokens are row-major over the person | garment grid
+        grid = torch.ones(rows, 2 * cols, dtype=torch.bool, device=keep.device)
+        grid[:, cols:] = keep
+        return grid.flatten().nonzero().squeeze(1)
+
     # Copied from diffusers.pipelines.flux.pipeline_flux.FluxPipeline.prepare_latents
     def prepare_latents(
         self,
@@ -313,6 +491,11 @@ class FluxTryOnPipeline(
     @property
     def interrupt(self):
         return self._interrupt
+
+    @property
+    def num_skipped_steps(self):
+        block_cache = self.transformer.block_cache
+        return block_cache.num_skipped_steps if block_cache is not None else 0
     
     @torch.no_grad()
     def __call__(
@@ -335,6 +518,10 @@ class FluxTryOnPipeline(
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 512,
+        prune_garment_tokens: bool = False,
+        prune_threshold: float = 0.94,
+        sampler: Optional[str] = None,
+        sigma_schedule: str = "linspace",
     ):
         height = height or self.default_sample_size * self.vae_scale_factor
         width = width or self.default_sample_size * self.vae_scale_factor
@@ -356,7 +543,11 @@ class FluxTryOnPipeline(
         self._interrupt = False
         
         # 2. Define call parameters
-        batch_size = 1
+        # TryOnEdit: every (person, garment, mask) triple is one sample of the transformer batch
+        if image is not None:
+            batch_size = self._num_images(image)
+        else:
+            batch_size = masked_image_latents.shape[0] // num_images_per_prompt
         device = self._execution_device
         dtype = self.transformer.dtype
         
@@ -377,11 +568,18 @@ class FluxTryOnPipeline(
             generator,
             latents,
         )
+        image_rotary_emb = self.rotary_embedding(
+            int(height) // (self.vae_scale_factor * 2), int(width * 2) // (self.vae_scale_factor * 2), device, dtype
+        )
         
         # 5. Prepare mask and masked image latents
+        garment_pixels = None
         if masked_image_latents is not None:
             masked_image_latents = masked_image_latents.to(latents.device)
         else:
+            condition_cache_keys = None
+            if self.latent_cache is not None:
+                condition_cache_keys = GarmentLatentCache.make_keys(condition_image, self.vae, height, width)
             image = self.image_processor.preprocess(image, height=height, width=width)
             condition_image = self.image_processor.preprocess(condition_image, height=height, width=width)
             mask_image = self.mask_processor.preprocess(mask_image, height=height, width=width)
@@ -391,7 +589,10 @@ class FluxTryOnPipeline(
             
             # TryOnEdit: Concat condition image to masked image
             condition_image = condition_image.to(device=device, dtype=dtype)
-            masked_image = torch.cat((masked_image, condition_image), dim=-1)
+            garment_pixels = condition_image
+            if condition_cache_keys is None:
+                masked_image = torch.cat((masked_image, condition_image), dim=-1)
+                condition_image = None
             mask_image = torch.cat((mask_image, torch.zeros_like(mask_image)), dim=-1)
 
             height, width = image.shape[-2:]
@@ -406,11 +607,14 @@ class FluxTryOnPipeline(
                 dtype,
                 device,
                 generator,
+                condition_image=condition_image,
+                condition_cache_keys=condition_cache_keys,
             )
             masked_image_latents = torch.cat((masked_image_latents, mask), dim=-1)
         
         # 6. Prepare timesteps
-        sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps) if sigmas is None else sigmas
+        # TryOnEdit: `sigma_schedule` picks one of the unshifted schedules of `model.flux.sampling`
+        sigmas = flux_sigmas(num_inference_steps, sigma_schedule) if sigmas is None else sigmas
         image_seq_len = latents.shape[1]
         mu = calculate_shift(
             image_seq_len,
@@ -429,6 +633,19 @@ class FluxTryOnPipeline(
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
         self._num_timesteps = len(timesteps)
         
+        # TryOnEdit: garment-token pruning. The kept tokens are chosen once from the garment pixels and the same
+        # ones are used on every step; the position ids travel with them, so the rotary embedding stays correct.
+        # Dropped tokens are garment tokens, which are discarded at decode anyway.
+        token_index = None
+        if prune_garment_tokens and garment_pixels is not None:
+            num_tokens = latents.shape[1]
+            token_index = self.garment_token_index(garment_pixels, prune_threshold)
+            latents = latents[:, token_index]
+            masked_image_latents = masked_image_latents[:, token_index]
+            latent_image_ids = latent_image_ids[token_index]
+            image_rotary_emb = tuple(emb[token_index] for emb in image_rotary_emb)
+            logger.info(f"Garment-token pruning keeps {latents.shape[1]} of {num_tokens} tokens.")
+
         # handle guidance
         if self.transformer.config.guidance_embeds:
             guidance = torch.full([1], guidance_scale, device=device, dtype=torch.float32)
@@ -436,31 +653,52 @@ class FluxTryOnPipeline(
         else:
             guidance = None
         
+        # TryOnEdit: the time embedding only depends on the schedule, so it is computed for all steps at once. A LoRA
+        # scale passed at call time is applied inside the transformer, and CPU offload hooks only move the weights on
+        # `forward`, so both cases fall back to per-step embedding inside the transformer.
+        temb = None
+        if lora_scale is None and not self._is_offloaded(self.transformer):
+            temb = self.time_embeddings(timesteps, guidance_scale, dtype)
+
         # 7. Denoising loop
         pooled_prompt_embeds = torch.zeros([latents.shape[0], 768], device=device, dtype=dtype) # TryOnEdit: for now, we don't use pooled prompt embeddings
+        if self.transformer.block_cache is not None:
+            self.transformer.block_cache.reset()
+        # TryOnEdit: a `model.flux.sampling` sampler integrates over the scheduler's shifted sigmas instead of
+        # `scheduler.step`; higher-order ones evaluate the transformer again at later steps' timesteps
+        sampler = get_sampler(sampler, self.scheduler.sigmas.tolist()) if sampler is not None else None
+
+        def predict(x, j):
+            x = x.to(masked_image_latents.dtype)
+            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+            timestep = timesteps[j].expand(x.shape[0]).to(x.dtype)
+            return self.transformer(
+                hidden_states=torch.cat((x, masked_image_latents), dim=2),
+                timestep=timestep / 1000,
+                guidance=guidance,
+                pooled_projections=pooled_prompt_embeds,
+                encoder_hidden_states=None,
+                txt_ids=None,
+                img_ids=latent_image_ids,
+                joint_attention_kwargs=self.joint_attention_kwargs,
+                return_dict=False,
+                image_rotary_emb=image_rotary_emb,
+                temb=temb[j : j + 1].expand(x.shape[0], -1) if temb is not None else None,
+            )[0]
+
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 if self.interrupt:
                     continue
-                
-                # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-                timestep = t.expand(latents.shape[0]).to(latents.dtype)
-
-                noise_pred = self.transformer(
-                    hidden_states=torch.cat((latents, masked_image_latents), dim=2),
-                    timestep=timestep / 1000,
-                    guidance=guidance,
-                    pooled_projections=pooled_prompt_embeds,
-                    encoder_hidden_states=None,
-                    txt_ids=None,
-                    img_ids=latent_image_ids,
-                    joint_attention_kwargs=self.joint_attention_kwargs,
-                    return_dict=False,
-                )[0]
+
+                noise_pred = predict(latents, i)
 
                 # compute the previous noisy sample x_t -> x_t-1
                 latents_dtype = latents.dtype
-                latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+                if sampler is None:
+                    latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+                else:
+                    latents = sampler.step(predict, noise_pred.float(), latents.float(), i).to(latents_dtype)
 
                 if latents.dtype != latents_dtype:
                     if torch.backends.mps.is_available():
@@ -480,6 +718,10 @@ class FluxTryOnPipeline(
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                     progress_bar.update()
 
+        # TryOnEdit: scatter the kept tokens back into the full person | garment layout
+        if token_index is not None:
+            latents = latents.new_zeros(latents.shape[0], num_tokens, latents.shape[-1]).index_copy_(1, token_index, latents)
+
         # 8. Post-process the image
         if output_type == "latent":
             image = latents
@@ -0,0 +1,116 @@
+from typing import Callable, Sequence
+
+import numpy as np
+import torch
+
+# Unshifted sigma schedules selectable with `sigma_schedule=`; the resolution-dependent shift (`mu`) is still
+# applied on top by the scheduler.
+# - "linspace": FLUX's default `np.linspace(1.0, 1 / n, n)`.
+# - "power": `(1 - i / n) ** rho`, a heuristic that moves steps towards the low-noise end where few-step
+#   trajectories lose detail. It is not tuned; compare it with `python benchmark.py flux-samplers`.
+SIGMA_SCHEDULES = ("linspace", "power")
+
+
+def flux_sigmas(num_inference_steps: int, sigma_schedule: str = "linspace", rho: float = 1.25) -> np.ndarray:
+    """
+    Unshifted sigmas for `num_inference_steps` under `sigma_schedule`.
+    """
+    if sigma_schedule == "linspace":
+        return np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
+    if sigma_schedule == "power":
+        return (1 - np.arange(num_inference_steps) / num_inference_steps) ** rho
+    raise ValueError(f"Unknown sigma schedule {sigma_schedule}, expected one of {list(SIGMA_SCHEDULES)}")
+
+
+class FlowMatchSampler:
+    """
+    Integrates the flow-matching ODE `dx/dsigma = v(x, sigma)` over the (shifted) `sigmas` of one call, ending at 0.
+
+    `step` receives the velocity the pipeline already predicted at `sigmas[i]` and a `model(x, j)` callable that
+    predicts the velocity at `sigmas[j]`, for samplers that need extra evaluations. Samplers keep per-trajectory
+    state, so a new one is built for every call.
+    """
+
+    # model evaluations per step, for reporting
+    nfe_per_step = 1
+
+    def __init__(self, sigmas: Sequence[float]):
+        self.sigmas = [float(sigma) for sigma in sigmas]
+        if self.sigmas[-1] != 0.0:
+            self.sigmas.append(0.0)
+
+    def step(self, model: Callable[[torch.Tensor, int], torch.Tensor], v: torch.Tensor, x: torch.Tensor, i: int) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class EulerSampler(FlowMatchSampler):
+    """
+    First-order Euler, the same update as `FlowMatchEulerDiscreteScheduler`.
+    """
+
+    def step(self, model, v, x, i):
+        return x + (self.sigmas[i + 1] - self.sigmas[i]) * v
+
+
+class HeunSampler(FlowMatchSampler):
+    """
+    Second-order Heun: an Euler predictor, then the average of the velocities at both ends. Two model evaluations
+    per step except the last, which is a plain Euler step to sigma 0.
+    """
+
+    nfe_per_step = 2
+
+    def step(self, model, v, x, i):
+        sigma, sigma_next = self.sigmas[i], self.sigmas[i + 1]
+        x_next = x + (sigma_next - sigma) * v
+        if sigma_next == 0.0:
+            return x_next
+        v_next = model(x_next, i + 1).float()
+        return x + (sigma_next - sigma) * (v + v_next) / 2
+
+
+class DPMSolverPP2MSampler(FlowMatchSampler):
+    """
+    DPM-Solver++(2M) in data prediction for the rectified-flow path `x = (1 - sigma) * x0 + sigma * noise`: one model
+    evaluation per step, second order from the previous step's `x0` estimate. Steps next to sigma 1 (where the log
+    SNR is -inf, so there is no usable previous step size) and the last step (to sigma 0) are first order.
+    """
+
+    def __init__(self, sigmas: Sequence[float]):
+        super().__init__(sigmas)
+        self.prev_x0 = None
+        self.prev_h = None
+
+    @staticmethod
+    def lambda_(sigma: float) -> float:
+        # log signal-to-noise ratio log(alpha / sigma), alpha = 1 - sigma
+        return np.log(1 - sigma) - np.log(sigma) if 0.0 < sigma < 1.0 else (-np.inf if sigma >= 1.0 else np.inf)
+
+    def step(self, model, v, x, i):
+        sigma, sigma_next = self.sigmas[i], self.sigmas[i + 1]
+        x0 = x - sigma * v
+        if sigma_next == 0.0:
+            return x0
+        h = self.lambda_(sigma_next) - self.lambda_(sigma)
+        denoised = x0
+        if self.prev_x0 is not None and np.isfinite(self.prev_h) and np.isfinite(h):
+            r = self.prev_h / h
+            denoised = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * self.prev_x0
+        self.prev_x0, self.prev_h = x0, h
+        # (sigma' / sigma) x - alpha' (exp(-h) - 1) D, written without exp(-h) so it stays finite at sigma = 1
+        alpha, alpha_next = 1 - sigma, 1 - sigma_next
+        return (sigma_next / sigma) * x - (sigma_next * alpha / sigma - alpha_next) * denoised
+
+
+# Samplers selectable per call with `sampler=`; `None` keeps the pipeline's scheduler
+SAMPLERS = {
+    "euler": EulerSampler,
+    "heun": HeunSampler,
+    "dpm++2m": DPMSolverPP2MSampler,
+}
+
+
+def get_sampler(name: str, sigmas: Sequence[float]) -> FlowMatchSampler:
+    if name not in SAMPLERS:
+        raise ValueError(f"Unknown sampler {name}, expected one of {list(SAMPLERS)}")
+    return SAMPLERS[name](sigmas)
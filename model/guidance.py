@@ -0,0 +1,69 @@
+from typing import Optional, Tuple
+
+import torch
+
+
+class GuidanceSchedule:
+    """
+    Decides on which denoising steps classifier-free guidance runs the unconditional branch.
+
+    - `interval`: fractions `(start, end)` of the trajectory (0 is the first step) where full CFG runs; outside it
+      only the conditional branch is evaluated.
+    - `uncond_every`: inside the interval, run the unconditional branch only every n-th step.
+    - `adaptive_threshold`: once `||cond - uncond|| / ||cond||` of a full step (worst sample in the batch) falls
+      below this, the remaining steps skip the unconditional branch.
+    - `reuse_delta`: on skipped steps, extrapolate with the last guidance delta, `cond + (g - 1) * delta`, instead
+      of using the plain conditional prediction.
+
+    The default schedule runs full CFG on every step, like plain `guidance_scale > 1`.
+    """
+
+    def __init__(
+        self,
+        interval: Tuple[float, float] = (0.0, 1.0),
+        uncond_every: int = 1,
+        adaptive_threshold: Optional[float] = None,
+        reuse_delta: bool = False,
+    ):
+        self.interval = interval
+        self.uncond_every = uncond_every
+        self.adaptive_threshold = adaptive_threshold
+        self.reuse_delta = reuse_delta
+        self.reset()
+
+    def reset(self):
+        # called once per pipeline call
+        self.last_delta = None
+        self.converged = False
+        self.num_skipped_steps = 0
+
+    def use_uncond(self, step: int, num_steps: int) -> bool:
+        start, end = self.interval
+        full = (
+            not self.converged
+            and start <= step / num_steps < end
+            and (step - int(start * num_steps)) % self.uncond_every == 0
+        )
+        self.num_skipped_steps += not full
+        return full
+
+    def combine(self, noise_pred_uncond: torch.Tensor, noise_pred_text: torch.Tensor, guidance_scale: float) -> torch.Tensor:
+        """
+        Guided prediction of a full step, recording the delta for later skipped steps.
+        """
+        delta = noise_pred_text - noise_pred_uncond
+        if self.adaptive_threshold is not None:
+            ratio = delta.flatten(1).norm(dim=1) / noise_pred_text.flatten(1).norm(dim=1).clamp_min(1e-6)
+            self.converged = ratio.max().item() < self.adaptive_threshold
+        if self.reuse_delta:
+            self.last_delta = delta
+            return noise_pred_uncond + guidance_scale * delta
+        return delta.mul_(guidance_scale).add_(noise_pred_uncond)
+
+    def extrapolate(self, noise_pred_text: torch.Tensor, guidance_scale: float) -> torch.Tensor:
+        """
+        Prediction of a cond-only step.
+        """
+        if self.reuse_delta and self.last_delta is not None:
+            return noise_pred_text.add_(self.last_delta, alpha=guidance_scale - 1)
+        return noise_pred_text
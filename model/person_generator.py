@@ -0,0 +1,138 @@
+import threading
+from typing import List, Optional, Union
+
+import PIL
+import torch
+from diffusers import FluxPipeline, FluxTransformer2DModel
+from transformers import T5EncoderModel
+
+from model.cache import PromptEmbedsCache
+
+
+def module_bytes(module: Optional[torch.nn.Module]) -> int:
+    if module is None:
+        return 0
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+
+class FluxPersonGenerator:
+    """
+    Text-to-person generator on FLUX.1-dev with the NF4 (4-bit) T5 encoder and transformer.
+
+    Both stages are loaded once and reused across requests: the text stage (CLIP + T5) that turns the prompt into
+    embeddings, and the image stage (NF4 transformer + VAE) that denoises. Where the weights live is decided once
+    from `memory_budget` (bytes of GPU memory the generator may keep resident; by default the free memory at load
+    time minus `memory_headroom`, which is kept back for the activations of this and other models in the process):
+    stages that fit are kept on the GPU, the rest use model CPU offload, which keeps them in host memory and moves
+    them per forward instead of reloading them from disk.
+
+    With a `PromptEmbedsCache`, repeated prompts reuse their embeddings, and the text stage is only loaded on the
+    first cache miss.
+    """
+
+    def __init__(
+        self,
+        base_ckpt: str = "black-forest-labs/FLUX.1-dev",
+        nf4_ckpt: str = "sayakpaul/flux.1-dev-nf4-pkg",
+        device: str = "cuda",
+        torch_dtype=torch.float16,
+        memory_budget: Optional[int] = None,
+        memory_headroom: int = 6 << 30,
+        prompt_cache: Optional[PromptEmbedsCache] = None,
+    ):
+        self.base_ckpt = base_ckpt
+        self.nf4_ckpt = nf4_ckpt
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.prompt_cache = prompt_cache
+        transformer = FluxTransformer2DModel.from_pretrained(nf4_ckpt, subfolder="transformer")
+        self.image_pipeline = FluxPipeline.from_pretrained(
+            base_ckpt,
+            text_encoder=None,
+            text_encoder_2=None,
+            tokenizer=None,
+            tokenizer_2=None,
+            transformer=transformer,
+            torch_dtype=torch_dtype,
+        )
+        if memory_budget is None:
+            free = torch.cuda.mem_get_info(self.device)[0] if torch.cuda.is_available() else 0
+            memory_budget = max(free - memory_headroom, 0)
+        self.memory_budget = memory_budget
+        self.resident = {"image": self.place(self.image_pipeline, self.image_pipeline.transformer, self.image_pipeline.vae)}
+        self.text_pipeline = None
+        if prompt_cache is None:
+            self.load_text_pipeline()
+        # offload hooks move weights in and out of the GPU, so requests are served one at a time
+        self._lock = threading.Lock()
+
+    def place(self, pipeline: FluxPipeline, *modules: torch.nn.Module) -> bool:
+        """
+        Keep `pipeline` on the GPU if its `modules` fit in what is left of the memory budget, otherwise CPU offload it.
+        The image stage is placed first since it runs every denoising step.
+        """
+        size = sum(module_bytes(module) for module in modules)
+        resident = size <= self.memory_budget
+        if resident:
+            self.memory_budget -= size
+            pipeline.to(self.device)
+        else:
+            pipeline.enable_model_cpu_offload()
+        print(f"FluxPersonGenerator: {pipeline.__class__.__name__} with {size / (1 << 30):.1f} GiB of weights "
+              f"{'resident' if resident else 'offloaded'}")
+        return resident
+
+    def load_text_pipeline(self):
+        text_encoder_2 = T5EncoderModel.from_pretrained(self.nf4_ckpt, subfolder="text_encoder_2")
+        self.text_pipeline = FluxPipeline.from_pretrained(
+            self.base_ckpt,
+            text_encoder_2=text_encoder_2,
+            transformer=None,
+            vae=None,
+            torch_dtype=self.torch_dtype,
+        )
+        self.resident["text"] = self.place(self.text_pipeline, self.text_pipeline.text_encoder, text_encoder_2)
+
+    @torch.no_grad()
+    def encode_prompt(self, prompt: str, max_sequence_length: int = 256):
+        key = None
+        if self.prompt_cache is not None:
+            key = PromptEmbedsCache.make_key(prompt, max_sequence_length, f"{self.base_ckpt}:{self.nf4_ckpt}")
+            if (cached := self.prompt_cache.get(key)) is not None:
+                return cached["prompt_embeds"], cached["pooled_prompt_embeds"]
+        if self.text_pipeline is None:
+            self.load_text_pipeline()
+        prompt_embeds, pooled_prompt_embeds, text_ids = self.text_pipeline.encode_prompt(
+            prompt=prompt, prompt_2=None, max_sequence_length=max_sequence_length
+        )
+        if key is not None:
+            self.prompt_cache.put(key, {
+                "prompt_embeds": prompt_embeds,
+                "pooled_prompt_embeds": pooled_prompt_embeds,
+                "text_ids": text_ids,
+            })
+        return prompt_embeds, pooled_prompt_embeds
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        prompt: str,
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 5.5,
+        max_sequence_length: int = 256,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> List[PIL.Image.Image]:
+        with self._lock:
+            prompt_embeds, pooled_prompt_embeds = self.encode_prompt(prompt, max_sequence_length)
+            return self.image_pipeline(
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                height=height,
+                width=width,
+                generator=generator,
+                output_type="pil",
+            ).images
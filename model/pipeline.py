@@ -1,23 +1,42 @@
 import inspect
 import os
-from typing import Union
+from typing import List, Optional, Union
 
 import PIL
+import PIL.ImageFilter
 import numpy as np
 import torch
 import tqdm
 from accelerate import load_checkpoint_in_model
-from diffusers import AutoencoderKL, DDIMScheduler, UNet2DConditionModel
+from diffusers import (AutoencoderKL, DDIMScheduler,
+                       DPMSolverMultistepScheduler,
+                       EulerAncestralDiscreteScheduler, LCMScheduler,
+                       UNet2DConditionModel, UniPCMultistepScheduler)
 from diffusers.pipelines.stable_diffusion.safety_checker import \
     StableDiffusionSafetyChecker
 from diffusers.utils.torch_utils import randn_tensor
 from huggingface_hub import snapshot_download
 from transformers import CLIPImageProcessor
 
-from model.attn_processor import SkipAttnProcessor
+from model.attn_processor import (CachedKVAttnProcessor2_0,
+                                  GarmentKVCacheState, SkipAttnProcessor)
+from model.cache import GarmentLatentCache
+from model.guidance import GuidanceSchedule
 from model.utils import get_trainable_module, init_adapter
-from utils import (compute_vae_encodings, numpy_to_pil, prepare_image,
-                   prepare_mask_image, resize_and_crop, resize_and_padding)
+from utils import (compute_vae_encodings, mask_crop_box, numpy_to_pil,
+                   prepare_image, prepare_mask_image, repaint_result,
+                   resize_and_crop, resize_and_padding,
+                   resize_and_padding_tensor)
+
+# Samplers selectable per call with `scheduler=`, built from the base DDIM config: (class, config overrides)
+SCHEDULERS = {
+    "ddim": (DDIMScheduler, {}),
+    "dpm++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "solver_order": 2}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    # consistency sampling, only meaningful with LCM-distilled weights
+    "lcm": (LCMScheduler, {}),
+}
 
 
 class CatVTONPipeline:
@@ -31,10 +50,14 @@ class CatVTONPipeline:
         compile=False,
         skip_safety_check=False,
         use_tf32=True,
+        latent_cache=None,
     ):
         self.device = device
         self.weight_dtype = weight_dtype
         self.skip_safety_check = skip_safety_check
+        self.latent_cache = latent_cache  # optional `model.cache.GarmentLatentCache` for condition images
+        self.garment_kv_cache = None  # `GarmentKVCacheState` while `enable_garment_kv_cache` is on
+        self._default_attn_processors = None
 
         self.noise_scheduler = DDIMScheduler.from_pretrained(base_ckpt, subfolder="scheduler")
         self.vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse").to(device, dtype=weight_dtype)
@@ -68,6 +91,78 @@ class CatVTONPipeline:
             print(f"Downloaded {attn_ckpt} to {repo_path}")
             load_checkpoint_in_model(self.attn_modules, os.path.join(repo_path, sub_folder, 'attention'))
             
+    def enable_vae_slicing(self):
+        r"""
+        Enable sliced VAE encoding and decoding. When this option is enabled, the VAE will split the batch in slices
+        and process one sample at a time. This is useful to save some memory and allow larger batch sizes.
+        """
+        getattr(self.vae, "_orig_mod", self.vae).enable_slicing()
+
+    def disable_vae_slicing(self):
+        r"""
+        Disable sliced VAE encoding and decoding. If `enable_vae_slicing` was previously enabled, this method will go
+        back to processing the batch in one step.
+        """
+        getattr(self.vae, "_orig_mod", self.vae).disable_slicing()
+
+    def enable_vae_tiling(self, tile_sample_min_size: Optional[int] = None, tile_overlap_factor: Optional[float] = None):
+        r"""
+        Enable tiled VAE encoding and decoding. When this option is enabled, the VAE will split images larger than
+        `tile_sample_min_size` pixels into overlapping tiles and blend the seams linearly across the overlap
+        (`tile_overlap_factor` of a tile). This keeps peak memory flat at 1536/2048 heights, on GPU or CPU.
+        """
+        vae = getattr(self.vae, "_orig_mod", self.vae)
+        vae.enable_tiling()
+        if tile_sample_min_size is not None:
+            vae.tile_sample_min_size = tile_sample_min_size
+            vae.tile_latent_min_size = int(tile_sample_min_size / (2 ** (len(vae.config.block_out_channels) - 1)))
+        if tile_overlap_factor is not None:
+            vae.tile_overlap_factor = tile_overlap_factor
+
+    def disable_vae_tiling(self):
+        r"""
+        Disable tiled VAE encoding and decoding. If `enable_vae_tiling` was previously enabled, this method will go
+        back to processing each image in one step.
+        """
+        getattr(self.vae, "_orig_mod", self.vae).disable_tiling()
+
+    def enable_garment_kv_cache(self, refresh_interval: int = 3, warmup_steps: int = 5, final_steps: int = 2):
+        """
+        Opt-in approximate mode: self-attention reuses the garment-half keys/values and outputs between refresh
+        steps (see `CachedKVAttnProcessor2_0`), trading some fidelity for roughly half the attention cost.
+        """
+        unet = getattr(self.unet, "_orig_mod", self.unet)
+        if self._default_attn_processors is None:
+            self._default_attn_processors = dict(unet.attn_processors)
+        self.garment_kv_cache = GarmentKVCacheState(refresh_interval, warmup_steps, final_steps)
+        unet.set_attn_processor({
+            name: CachedKVAttnProcessor2_0(self.garment_kv_cache) if name.endswith("attn1.processor") else processor
+            for name, processor in self._default_attn_processors.items()
+        })
+
+    def disable_garment_kv_cache(self):
+        if self._default_attn_processors is not None:
+            getattr(self.unet, "_orig_mod", self.unet).set_attn_processor(self._default_attn_processors)
+        self.garment_kv_cache = None
+        self._default_attn_processors = None
+
+    def composite_crops(self, crops, full_image, full_mask, offset):
+        """
+        Paste the decoded crops of cropped mode back at `offset` (top, left) and blend them into the full person
+        images through the feathered mask, so only the masked area changes.
+        """
+        top, left = offset
+        persons = numpy_to_pil((full_image / 2 + 0.5).clamp(0, 1).cpu().permute(0, 2, 3, 1).float().numpy())
+        masks = numpy_to_pil(full_mask.cpu().permute(0, 2, 3, 1).float().numpy())
+        results = []
+        for crop, person, mask in zip(crops, persons, masks):
+            kernel_size = person.height // 50
+            mask = mask.filter(PIL.ImageFilter.GaussianBlur(kernel_size + (kernel_size % 2 == 0)))
+            result = person.copy()
+            result.paste(crop, (left, top))
+            results.append(repaint_result(result, person, mask))
+        return results
+
     def run_safety_checker(self, image):
         if self.safety_checker is None:
             has_nsfw_concept = None
@@ -81,20 +176,45 @@ class CatVTONPipeline:
     def check_inputs(self, image, condition_image, mask, width, height):
         if isinstance(image, torch.Tensor) and isinstance(condition_image, torch.Tensor) and isinstance(mask, torch.Tensor):
             return image, condition_image, mask
+        if isinstance(image, list):
+            assert len(image) == len(condition_image) == len(mask), "Image, condition image and mask lists must have the same length"
+            items = image + condition_image + mask
+            if all(isinstance(item, torch.Tensor) for item in items):
+                # batch tensor items like a batched tensor input, which `prepare_image` / `prepare_mask_image` handle
+                return tuple(torch.cat([t if t.ndim == 4 else t[None] for t in _]) for _ in (image, condition_image, mask))
+            assert all(isinstance(item, PIL.Image.Image) for item in items), (
+                "Image, condition image and mask lists must contain only PIL images or only tensors"
+            )
+            checked = [self.check_inputs(i, c, m, width, height) for i, c, m in zip(image, condition_image, mask)]
+            image, condition_image, mask = (list(_) for _ in zip(*checked))
+            return image, condition_image, mask
         assert image.size == mask.size, "Image and mask must have the same size"
         image = resize_and_crop(image, (width, height))
         mask = resize_and_crop(mask, (width, height))
         condition_image = resize_and_padding(condition_image, (width, height))
         return image, condition_image, mask
     
-    def prepare_extra_step_kwargs(self, generator, eta):
+    def get_scheduler(self, scheduler: Optional[str] = None):
+        """
+        A fresh scheduler for one call: the default DDIM one, or a `SCHEDULERS` entry built from its config.
+        Multistep schedulers keep per-trajectory state, so instances are not shared between calls.
+        """
+        if scheduler is None:
+            return self.noise_scheduler
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler {scheduler}, expected one of {list(SCHEDULERS)}")
+        scheduler_cls, overrides = SCHEDULERS[scheduler]
+        return scheduler_cls.from_config(self.noise_scheduler.config, **overrides)
+
+    def prepare_extra_step_kwargs(self, generator, eta, noise_scheduler=None):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
+        noise_scheduler = self.noise_scheduler if noise_scheduler is None else noise_scheduler
 
         accepts_eta = "eta" in set(
-            inspect.signature(self.noise_scheduler.step).parameters.keys()
+            inspect.signature(noise_scheduler.step).parameters.keys()
         )
         extra_step_kwargs = {}
         if accepts_eta:
@@ -102,7 +222,7 @@ class CatVTONPipeline:
 
         # check if the scheduler accepts generator
         accepts_generator = "generator" in set(
-            inspect.signature(self.noise_scheduler.step).parameters.keys()
+            inspect.signature(noise_scheduler.step).parameters.keys()
         )
         if accepts_generator:
             extra_step_kwargs["generator"] = generator
@@ -120,19 +240,44 @@ class CatVTONPipeline:
         width: int = 768,
         generator=None,
         eta=1.0,
+        guidance_schedule: Optional[GuidanceSchedule] = None,
+        scheduler: Optional[str] = None,
+        crop_to_mask: bool = False,
+        crop_padding: float = 0.1,
         **kwargs
     ):
         concat_dim = -2  # FIXME: y axis concat
         # Prepare inputs to Tensor
         image, condition_image, mask = self.check_inputs(image, condition_image, mask, width, height)
+        condition_inputs = condition_image
         image = prepare_image(image).to(self.device, dtype=self.weight_dtype)
         condition_image = prepare_image(condition_image).to(self.device, dtype=self.weight_dtype)
         mask = prepare_mask_image(mask).to(self.device, dtype=self.weight_dtype)
+        # Cropped mode: denoise only a padded box around the mask (shared by the batch) with the garment fitted to it
+        crop_box = None
+        if crop_to_mask:
+            crop_box = mask_crop_box(
+                torch.nn.functional.interpolate(mask, size=(height // 8, width // 8), mode="nearest"), padding=crop_padding
+            )
+        if crop_box is not None:
+            top, left, bottom, right = (8 * _ for _ in crop_box)
+            full_image, full_mask = image, mask
+            image, mask = image[..., top:bottom, left:right], mask[..., top:bottom, left:right]
+            height, width = bottom - top, right - left
+            condition_image = resize_and_padding_tensor(condition_image, (width, height))
+        condition_cache_keys = GarmentLatentCache.make_keys(condition_inputs, self.vae, height, width) if self.latent_cache is not None else None
         # Mask image
         masked_image = image * (mask < 0.5)
         # VAE encoding
-        masked_latent = compute_vae_encodings(masked_image, self.vae)
-        condition_latent = compute_vae_encodings(condition_image, self.vae)
+        if self.latent_cache is None:
+            # one encoder pass for person and garment, per-sample generators are repeated so each draws in the same order
+            masked_latent, condition_latent = compute_vae_encodings(
+                torch.cat([masked_image, condition_image]), self.vae,
+                generator=generator * 2 if isinstance(generator, list) else generator,
+            ).chunk(2)
+        else:
+            masked_latent = compute_vae_encodings(masked_image, self.vae, generator=generator)
+            condition_latent = compute_vae_encodings(condition_image, self.vae, cache=self.latent_cache, cache_keys=condition_cache_keys, generator=generator)
         mask_latent = torch.nn.functional.interpolate(mask, size=masked_latent.shape[-2:], mode="nearest")
         del image, mask, condition_image
         # Concatenate latents
@@ -146,9 +291,10 @@ class CatVTONPipeline:
             dtype=self.weight_dtype,
         )
         # Prepare timesteps
-        self.noise_scheduler.set_timesteps(num_inference_steps, device=self.device)
-        timesteps = self.noise_scheduler.timesteps
-        latents = latents * self.noise_scheduler.init_noise_sigma
+        noise_scheduler = self.get_scheduler(scheduler)
+        noise_scheduler.set_timesteps(num_inference_steps, device=self.device)
+        timesteps = noise_scheduler.timesteps
+        latents = latents * noise_scheduler.init_noise_sigma
         # Classifier-Free Guidance
         if do_classifier_free_guidance := (guidance_scale > 1.0):
             masked_latent_concat = torch.cat(
@@ -159,37 +305,57 @@ class CatVTONPipeline:
             )
             mask_latent_concat = torch.cat([mask_latent_concat] * 2)
 
+        # Preallocate the inpainting input [noisy latents | mask | masked latents] for the whole loop:
+        # the mask and masked-latent channels are written once, only the noisy slice changes per step
+        inpainting_latent_model_input = torch.cat(
+            [torch.cat([latents] * 2) if do_classifier_free_guidance else latents, mask_latent_concat, masked_latent_concat], dim=1
+        )
+        del mask_latent_concat, masked_latent_concat
+        non_inpainting_latent_model_input = inpainting_latent_model_input[:, :latents.shape[1]]
+        if do_classifier_free_guidance:
+            non_inpainting_latent_model_input = non_inpainting_latent_model_input.unflatten(0, (2, -1))
+
         # Denoising loop
-        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
-        num_warmup_steps = (len(timesteps) - num_inference_steps * self.noise_scheduler.order)
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta, noise_scheduler)
+        num_warmup_steps = (len(timesteps) - num_inference_steps * noise_scheduler.order)
+        if guidance_schedule is not None:
+            guidance_schedule.reset()
+        if self.garment_kv_cache is not None:
+            self.garment_kv_cache.reset()
         with tqdm.tqdm(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                non_inpainting_latent_model_input = (torch.cat([latents] * 2) if do_classifier_free_guidance else latents)
-                non_inpainting_latent_model_input = self.noise_scheduler.scale_model_input(non_inpainting_latent_model_input, t)
-                # prepare the input for the inpainting model
-                inpainting_latent_model_input = torch.cat([non_inpainting_latent_model_input, mask_latent_concat, masked_latent_concat], dim=1)
+                if self.garment_kv_cache is not None:
+                    self.garment_kv_cache.begin_step(i, len(timesteps))
+                # write the scaled latents into the noisy slice (broadcast to both CFG halves)
+                non_inpainting_latent_model_input.copy_(noise_scheduler.scale_model_input(latents, t))
+                # steps where the guidance schedule skips the unconditional branch run the cond half of the buffer only
+                use_uncond = do_classifier_free_guidance and (
+                    guidance_schedule is None or guidance_schedule.use_uncond(i, len(timesteps))
+                )
                 # predict the noise residual
                 noise_pred= self.unet(
-                    inpainting_latent_model_input,
+                    inpainting_latent_model_input if use_uncond or not do_classifier_free_guidance else inpainting_latent_model_input[latents.shape[0]:],
                     t.to(self.device),
                     encoder_hidden_states=None, # FIXME
                     return_dict=False,
                 )[0]
-                # perform guidance
-                if do_classifier_free_guidance:
+                # perform guidance, in place on the conditional half
+                if use_uncond:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (
-                        noise_pred_text - noise_pred_uncond
-                    )
+                    if guidance_schedule is not None:
+                        noise_pred = guidance_schedule.combine(noise_pred_uncond, noise_pred_text, guidance_scale)
+                    else:
+                        noise_pred = noise_pred_text.sub_(noise_pred_uncond).mul_(guidance_scale).add_(noise_pred_uncond)
+                elif do_classifier_free_guidance:
+                    noise_pred = guidance_schedule.extrapolate(noise_pred, guidance_scale)
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.noise_scheduler.step(
+                latents = noise_scheduler.step(
                     noise_pred, t, latents, **extra_step_kwargs
                 ).prev_sample
                 # call the callback, if provided
                 if i == len(timesteps) - 1 or (
                     (i + 1) > num_warmup_steps
-                    and (i + 1) % self.noise_scheduler.order == 0
+                    and (i + 1) % noise_scheduler.order == 0
                 ):
                     progress_bar.update()
 
@@ -201,6 +367,8 @@ class CatVTONPipeline:
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
         image = image.cpu().permute(0, 2, 3, 1).float().numpy()
         image = numpy_to_pil(image)
+        if crop_box is not None:
+            image = self.composite_crops(image, full_image, full_mask, (top, left))
         
         # Safety Check
         if not self.skip_safety_check:
@@ -214,6 +382,74 @@ class CatVTONPipeline:
                     image[i] = nsfw_image
         return image
 
+    def batch_call(
+        self,
+        images: List[PIL.Image.Image],
+        condition_images: List[PIL.Image.Image],
+        masks: List[PIL.Image.Image],
+        num_inference_steps: Union[int, List[int]] = 60,
+        guidance_scale: Union[float, List[float]] = 3.5,
+        seeds: Optional[List[Optional[int]]] = None,
+        height: int = 1024,
+        width: int = 768,
+        max_batch_size: int = 8,
+        eta=1.0,
+        **kwargs
+    ) -> List[PIL.Image.Image]:
+        """
+        Run try-on for many (person, garment, mask) triples in as few UNet batches as possible.
+
+        Items sharing the same `num_inference_steps` and `guidance_scale` are bucketed together and run through
+        `__call__` in chunks of at most `max_batch_size`. Each item gets its own generator seeded from `seeds`
+        (`None` or -1 draws a random seed), so its noise does not depend on which bucket it lands in.
+        Results are returned in input order.
+        """
+        num_items = len(images)
+        assert len(condition_images) == num_items and len(masks) == num_items, \
+            "images, condition_images and masks must have the same length"
+        if not isinstance(num_inference_steps, (list, tuple)):
+            num_inference_steps = [num_inference_steps] * num_items
+        if not isinstance(guidance_scale, (list, tuple)):
+            guidance_scale = [guidance_scale] * num_items
+        if seeds is None:
+            seeds = [None] * num_items
+        assert len(num_inference_steps) == len(guidance_scale) == len(seeds) == num_items, \
+            "Per-item settings must have the same length as the inputs"
+
+        generators = []
+        for seed in seeds:
+            generator = torch.Generator(device=self.device)
+            if seed is None or seed == -1:
+                generator.seed()
+            else:
+                generator.manual_seed(seed)
+            generators.append(generator)
+
+        # Bucket by the settings that must be shared inside one denoising loop
+        buckets = {}
+        for index in range(num_items):
+            buckets.setdefault((int(num_inference_steps[index]), float(guidance_scale[index])), []).append(index)
+
+        results = [None] * num_items
+        for (steps, scale), indices in buckets.items():
+            for start in range(0, len(indices), max_batch_size):
+                chunk = indices[start:start + max_batch_size]
+                outputs = self(
+                    image=[images[i] for i in chunk],
+                    condition_image=[condition_images[i] for i in chunk],
+                    mask=[masks[i] for i in chunk],
+                    num_inference_steps=steps,
+                    guidance_scale=scale,
+                    height=height,
+                    width=width,
+                    generator=[generators[i] for i in chunk],
+                    eta=eta,
+                    **kwargs
+                )
+                for i, output in zip(chunk, outputs):
+                    results[i] = output
+        return results
+
 
 class CatVTONPix2PixPipeline(CatVTONPipeline):
     def auto_attn_ckpt_load(self, attn_ckpt, version):
@@ -225,6 +461,10 @@ class CatVTONPix2PixPipeline(CatVTONPipeline):
             print(f"Downloaded {attn_ckpt} to {repo_path}")
             load_checkpoint_in_model(self.attn_modules, os.path.join(repo_path, version, 'attention'))
     
+    def enable_garment_kv_cache(self, *args, **kwargs):
+        # person and garment are concatenated along width here, so garment tokens are not one contiguous half
+        raise NotImplementedError("Garment K/V caching needs the height-concatenated layout of CatVTONPipeline")
+
     def check_inputs(self, image, condition_image, width, height):
         if isinstance(image, torch.Tensor) and isinstance(condition_image, torch.Tensor) and isinstance(torch.Tensor):
             return image, condition_image
@@ -243,16 +483,26 @@ class CatVTONPix2PixPipeline(CatVTONPipeline):
         width: int = 768,
         generator=None,
         eta=1.0,
+        guidance_schedule: Optional[GuidanceSchedule] = None,
+        scheduler: Optional[str] = None,
         **kwargs
     ):
         concat_dim = -1
         # Prepare inputs to Tensor
         image, condition_image = self.check_inputs(image, condition_image, width, height)
+        condition_cache_keys = GarmentLatentCache.make_keys(condition_image, self.vae, height, width) if self.latent_cache is not None else None
         image = prepare_image(image).to(self.device, dtype=self.weight_dtype)
         condition_image = prepare_image(condition_image).to(self.device, dtype=self.weight_dtype)
         # VAE encoding
-        image_latent = compute_vae_encodings(image, self.vae)
-        condition_latent = compute_vae_encodings(condition_image, self.vae)
+        if self.latent_cache is None:
+            # one encoder pass for person and garment, per-sample generators are repeated so each draws in the same order
+            image_latent, condition_latent = compute_vae_encodings(
+                torch.cat([image, condition_image]), self.vae,
+                generator=generator * 2 if isinstance(generator, list) else generator,
+            ).chunk(2)
+        else:
+            image_latent = compute_vae_encodings(image, self.vae, generator=generator)
+            condition_latent = compute_vae_encodings(condition_image, self.vae, cache=self.latent_cache, cache_keys=condition_cache_keys, generator=generator)
         del image, condition_image
         # Concatenate latents
         condition_latent_concat = torch.cat([image_latent, condition_latent], dim=concat_dim)
@@ -264,9 +514,10 @@ class CatVTONPix2PixPipeline(CatVTONPipeline):
             dtype=self.weight_dtype,
         )
         # Prepare timesteps
-        self.noise_scheduler.set_timesteps(num_inference_steps, device=self.device)
-        timesteps = self.noise_scheduler.timesteps
-        latents = latents * self.noise_scheduler.init_noise_sigma
+        noise_scheduler = self.get_scheduler(scheduler)
+        noise_scheduler.set_timesteps(num_inference_steps, device=self.device)
+        timesteps = noise_scheduler.timesteps
+        latents = latents * noise_scheduler.init_noise_sigma
         # Classifier-Free Guidance
         if do_classifier_free_guidance := (guidance_scale > 1.0):
             condition_latent_concat = torch.cat(
@@ -276,37 +527,53 @@ class CatVTONPix2PixPipeline(CatVTONPipeline):
                 ]
             )
 
+        # Preallocate the p2p input [noisy latents | condition latents] for the whole loop:
+        # the condition channels are written once, only the noisy slice changes per step
+        p2p_latent_model_input = torch.cat(
+            [torch.cat([latents] * 2) if do_classifier_free_guidance else latents, condition_latent_concat], dim=1
+        )
+        del condition_latent_concat
+        latent_model_input = p2p_latent_model_input[:, :latents.shape[1]]
+        if do_classifier_free_guidance:
+            latent_model_input = latent_model_input.unflatten(0, (2, -1))
+
         # Denoising loop
-        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
-        num_warmup_steps = (len(timesteps) - num_inference_steps * self.noise_scheduler.order)
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta, noise_scheduler)
+        num_warmup_steps = (len(timesteps) - num_inference_steps * noise_scheduler.order)
+        if guidance_schedule is not None:
+            guidance_schedule.reset()
         with tqdm.tqdm(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = (torch.cat([latents] * 2) if do_classifier_free_guidance else latents)
-                latent_model_input = self.noise_scheduler.scale_model_input(latent_model_input, t)
-                # prepare the input for the inpainting model
-                p2p_latent_model_input = torch.cat([latent_model_input, condition_latent_concat], dim=1)
+                # write the scaled latents into the noisy slice (broadcast to both CFG halves)
+                latent_model_input.copy_(noise_scheduler.scale_model_input(latents, t))
+                # steps where the guidance schedule skips the unconditional branch run the cond half of the buffer only
+                use_uncond = do_classifier_free_guidance and (
+                    guidance_schedule is None or guidance_schedule.use_uncond(i, len(timesteps))
+                )
                 # predict the noise residual
                 noise_pred= self.unet(
-                    p2p_latent_model_input,
+                    p2p_latent_model_input if use_uncond or not do_classifier_free_guidance else p2p_latent_model_input[latents.shape[0]:],
                     t.to(self.device),
                     encoder_hidden_states=None, 
                     return_dict=False,
                 )[0]
-                # perform guidance
-                if do_classifier_free_guidance:
+                # perform guidance, in place on the conditional half
+                if use_uncond:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (
-                        noise_pred_text - noise_pred_uncond
-                    )
+                    if guidance_schedule is not None:
+                        noise_pred = guidance_schedule.combine(noise_pred_uncond, noise_pred_text, guidance_scale)
+                    else:
+                        noise_pred = noise_pred_text.sub_(noise_pred_uncond).mul_(guidance_scale).add_(noise_pred_uncond)
+                elif do_classifier_free_guidance:
+                    noise_pred = guidance_schedule.extrapolate(noise_pred, guidance_scale)
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.noise_scheduler.step(
+                latents = noise_scheduler.step(
                     noise_pred, t, latents, **extra_step_kwargs
                 ).prev_sample
                 # call the callback, if provided
                 if i == len(timesteps) - 1 or (
                     (i + 1) > num_warmup_steps
-                    and (i + 1) % self.noise_scheduler.order == 0
+                    and (i + 1) % noise_scheduler.order == 0
                 ):
                     progress_bar.update()
 
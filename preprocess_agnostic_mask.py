@@ -23,6 +23,12 @@ def parse_args():
             "The Path or repo name of CatVTON. "
         ),
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Number of person images parsed per batch.",
+    )
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
@@ -48,15 +54,16 @@ def main(args):
         output_dir = os.path.join(args.data_root_path, sub_folder, 'agnostic_masks')
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        for line in tqdm(lines, desc=f"Processing {sub_folder}"):
-            person_img, _ = line.strip().split(" ")
-            if os.path.exists(os.path.join(output_dir, person_img.replace('.jpg', '.png'))):
-                continue
-            mask = automasker(
-                os.path.join(args.data_root_path, sub_folder, 'images', person_img),
+        person_imgs = [line.strip().split(" ")[0] for line in lines]
+        person_imgs = [_ for _ in person_imgs if not os.path.exists(os.path.join(output_dir, _.replace('.jpg', '.png')))]
+        for start in tqdm(range(0, len(person_imgs), args.batch_size), desc=f"Processing {sub_folder}"):
+            batch = person_imgs[start:start + args.batch_size]
+            results = automasker.batch_call(
+                [os.path.join(args.data_root_path, sub_folder, 'images', person_img) for person_img in batch],
                 cloth_type
-            )['mask']
-            mask.save(os.path.join(output_dir, person_img.replace('.jpg', '.png')))
+            )
+            for person_img, result in zip(batch, results):
+                result['mask'].save(os.path.join(output_dir, person_img.replace('.jpg', '.png')))
 
 if __name__ == "__main__":
     args = parse_args()
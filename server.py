@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+from typing import Optional
+
+import uvicorn
+from diffusers.image_processor import VaeImageProcessor
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import Response
+from huggingface_hub import snapshot_download
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from model.cache import GarmentLatentCache, ParsingCache
+from model.cloth_masker import AutoMasker
+from model.pipeline import CatVTONPipeline
+from utils import init_weight_dtype, resize_and_crop, resize_and_padding
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP server for CatVTON try-on.")
+    parser.add_argument(
+        "--base_model_path",
+        type=str,
+        default="booksforcharlie/stable-diffusion-inpainting",
+        help="The path to the base model to use for inference. This can be a local path or a model identifier from the Model Hub.",
+    )
+    parser.add_argument(
+        "--resume_path",
+        type=str,
+        default="zhengchong/CatVTON",
+        help="The Path to the checkpoint of trained tryon model.",
+    )
+    parser.add_argument("--width", type=int, default=768, help="Default width of the try-on results.")
+    parser.add_argument("--height", type=int, default=1024, help="Default height of the try-on results.")
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="bf16",
+        choices=["no", "fp16", "bf16"],
+        help="Whether to use mixed precision.",
+    )
+    parser.add_argument("--allow_tf32", action="store_true", default=True, help="Whether or not to allow TF32 on Ampere GPUs.")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Most requests run in one UNet batch.")
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=50,
+        help="How long the batcher waits for more requests after the first one before running a batch.",
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    return parser.parse_args()
+
+
+class Histogram:
+    """
+    Thread-safe histogram over fixed bucket upper bounds (the last bucket is open-ended).
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+            return {
+                "buckets": dict(zip(labels, self.counts)),
+                "count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+            }
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent try-on requests into batched `CatVTONPipeline.batch_call` runs.
+
+    A single worker thread owns the GPU. It blocks for the first queued request, then keeps collecting until
+    `max_batch_size` requests are queued or `max_wait_ms` have passed. The collected requests are grouped by
+    (height, width, steps, guidance), since those must be shared inside one denoising loop. Each group runs as one
+    batch and every request's future is resolved with its own image, or with the exception of its batch.
+    """
+
+    def __init__(self, pipeline: CatVTONPipeline, max_batch_size: int = 8, max_wait_ms: float = 50):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batch_sizes = Histogram(range(1, max_batch_size + 1))
+        self.queue_latency = Histogram([0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+        self.latency = Histogram([0.5, 1, 2, 4, 8, 16, 32, 64])
+        self.worker = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, person_image, cloth_image, mask, num_inference_steps, guidance_scale, seed, height, width) -> Future:
+        future = Future()
+        self.queue.put({
+            "person_image": person_image,
+            "cloth_image": cloth_image,
+            "mask": mask,
+            "key": (height, width, int(num_inference_steps), float(guidance_scale)),
+            "seed": seed,
+            "submitted": time.monotonic(),
+            "future": future,
+        })
+        return future
+
+    def _collect(self):
+        # requests whose future was cancelled (e.g. the client went away) are dropped here; the others are marked
+        # running, so they can no longer be cancelled while their batch runs
+        requests = []
+        deadline = None
+        while len(requests) < self.max_batch_size:
+            if deadline is None:
+                request = self.queue.get()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if not request["future"].set_running_or_notify_cancel():
+                continue
+            requests.append(request)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_wait
+        return requests
+
+    def _loop(self):
+        # the only consumer of the queue: nothing may escape this loop, or every later request would hang
+        while True:
+            try:
+                groups = {}
+                for request in self._collect():
+                    groups.setdefault(request["key"], []).append(request)
+            except Exception as e:
+                print(f"MicroBatcher: failed to collect requests: {e}")
+                continue
+            for key, requests in groups.items():
+                try:
+                    self._run_group(key, requests)
+                except Exception as e:
+                    print(f"MicroBatcher: failed to process a batch of {len(requests)}: {e}")
+                    for request in requests:
+                        if not request["future"].done():
+                            request["future"].set_exception(e)
+
+    def _run_group(self, key, requests):
+        height, width, steps, guidance = key
+        started = time.monotonic()
+        for request in requests:
+            self.queue_latency.observe(started - request["submitted"])
+        self.batch_sizes.observe(len(requests))
+        try:
+            results = self.pipeline.batch_call(
+                [request["person_image"] for request in requests],
+                [request["cloth_image"] for request in requests],
+                [request["mask"] for request in requests],
+                num_inference_steps=steps,
+                guidance_scale=guidance,
+                seeds=[request["seed"] for request in requests],
+                height=height,
+                width=width,
+                max_batch_size=self.max_batch_size,
+            )
+        except Exception as e:
+            for request in requests:
+                request["future"].set_exception(e)
+            return
+        finished = time.monotonic()
+        for request, result in zip(requests, results):
+            self.latency.observe(finished - request["submitted"])
+            request["future"].set_result(result)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "batch_size": self.batch_sizes.to_dict(),
+            "queue_latency_seconds": self.queue_latency.to_dict(),
+            "latency_seconds": self.latency.to_dict(),
+        }
+
+
+def create_app(args) -> FastAPI:
+    repo_path = snapshot_download(repo_id=args.resume_path)
+    pipeline = CatVTONPipeline(
+        base_ckpt=args.base_model_path,
+        attn_ckpt=repo_path,
+        attn_ckpt_version="mix",
+        weight_dtype=init_weight_dtype(args.mixed_precision),
+        use_tf32=args.allow_tf32,
+        device='cuda',
+        # entries are device tensors: this bounds GPU memory held by cached garment latents
+        latent_cache=GarmentLatentCache(max_bytes=1 << 30),
+    )
+    automasker = AutoMasker(
+        densepose_ckpt=os.path.join(repo_path, "DensePose"),
+        schp_ckpt=os.path.join(repo_path, "SCHP"),
+        device='cuda',
+        parsing_cache=ParsingCache(max_bytes=256 << 20),
+    )
+    automasker_lock = threading.Lock()
+    mask_processor = VaeImageProcessor(vae_scale_factor=8, do_normalize=False, do_binarize=True, do_convert_grayscale=True)
+    batcher = MicroBatcher(pipeline, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+
+    def prepare(person_bytes, cloth_bytes, mask_bytes, cloth_type, height, width):
+        person_image = resize_and_crop(Image.open(BytesIO(person_bytes)).convert("RGB"), (width, height))
+        cloth_image = resize_and_padding(Image.open(BytesIO(cloth_bytes)).convert("RGB"), (width, height))
+        if mask_bytes:
+            mask = resize_and_crop(Image.open(BytesIO(mask_bytes)).convert("L"), (width, height))
+        else:
+            with automasker_lock:
+                mask = automasker(person_image, cloth_type)['mask']
+        return person_image, cloth_image, mask_processor.blur(mask, blur_factor=9)
+
+    app = FastAPI(title="CatVTON")
+
+    @app.post("/tryon")
+    async def tryon(
+        person_image: UploadFile = File(...),
+        cloth_image: UploadFile = File(...),
+        mask: Optional[UploadFile] = File(None),
+        cloth_type: str = Form("upper"),
+        num_inference_steps: int = Form(50),
+        guidance_scale: float = Form(2.5),
+        seed: int = Form(-1),
+        height: int = Form(args.height),
+        width: int = Form(args.width),
+    ):
+        person_image, cloth_image, mask = await run_in_threadpool(
+            prepare,
+            await person_image.read(),
+            await cloth_image.read(),
+            await mask.read() if mask is not None else None,
+            cloth_type,
+            height,
+            width,
+        )
+        future = batcher.submit(person_image, cloth_image, mask, num_inference_steps, guidance_scale, seed, height, width)
+        result = await asyncio.wrap_future(future)
+        buffered = BytesIO()
+        result.save(buffered, format="PNG")
+        return Response(content=buffered.getvalue(), media_type="image/png")
+
+    @app.get("/metrics")
+    def metrics():
+        return {
+            **batcher.metrics(),
+            "garment_latent_cache": pipeline.latent_cache.stats(),
+            "parsing_cache": automasker.parsing_cache.stats(),
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port)
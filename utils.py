@@ -1,5 +1,6 @@
 import os
 
+import hashlib
 import math
 import PIL
 import numpy as np
@@ -96,27 +97,76 @@ def prepare_inpainting_input(
     return noisy_latents
 
 # Compute VAE encodings
-def compute_vae_encodings(image: torch.Tensor, vae: torch.nn.Module) -> torch.Tensor:
+def compute_vae_encodings(
+    image: torch.Tensor,
+    vae: torch.nn.Module,
+    cache=None,
+    cache_keys: Optional[List[str]] = None,
+    generator=None,
+) -> torch.Tensor:
     """
     Args:
         images (torch.Tensor): image to be encoded
         vae (torch.nn.Module): vae model
+        cache (GarmentLatentCache, optional): latent cache consulted per image, misses are encoded in one batch
+        cache_keys (List[str], optional): one cache key per image, required when `cache` is given
+        generator (torch.Generator or List[torch.Generator], optional): generator(s) for sampling the latent
+            distribution, one per image to make each sample independent of the batch
 
     Returns:
         torch.Tensor: latent encoding of the image
     """
-    pixel_values = image.to(memory_format=torch.contiguous_format).float()
-    pixel_values = pixel_values.to(vae.device, dtype=vae.dtype)
+    if cache is not None:
+        return compute_cached_vae_encodings(image, vae, cache, cache_keys, generator) * vae.config.scaling_factor
+    pixel_values = image.to(vae.device, dtype=vae.dtype, memory_format=torch.contiguous_format)
     with torch.no_grad():
-        model_input = vae.encode(pixel_values).latent_dist.sample()
+        model_input = vae.encode(pixel_values).latent_dist.sample(generator)
     model_input = model_input * vae.config.scaling_factor
     return model_input
 
 
+def compute_cached_vae_encodings(image: torch.Tensor, vae: torch.nn.Module, cache, cache_keys: List[str], generator=None) -> torch.Tensor:
+    """
+    Sample (unscaled) latents for a batch of images, running the VAE encoder only for images missing from `cache`.
+    The cache stores latent distribution parameters, so hits are sampled exactly like a fresh encode.
+    """
+    from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+
+    assert cache_keys is not None and len(cache_keys) == image.shape[0], "One cache key per image is required"
+    parameters = [cache.get(key) for key in cache_keys]
+    missing = [i for i, p in enumerate(parameters) if p is None]
+    if missing:
+        pixel_values = image[missing].to(vae.device, dtype=vae.dtype, memory_format=torch.contiguous_format)
+        with torch.no_grad():
+            missing_parameters = vae.encode(pixel_values).latent_dist.parameters
+        for i, p in zip(missing, missing_parameters):
+            p = p.clone()  # do not keep the whole miss batch alive through a view
+            cache.put(cache_keys[i], p)
+            parameters[i] = p
+    parameters = torch.stack([p.to(vae.device, dtype=vae.dtype) for p in parameters])
+    return DiagonalGaussianDistribution(parameters).sample(generator=generator)
+
+
 # Init Accelerator
 from accelerate import Accelerator, DistributedDataParallelKwargs
 from accelerate.utils import ProjectConfiguration
 
+def derive_seed(seed: int, sample_id) -> int:
+    """
+    Counter-style seed for one sample: a hash of the global seed and a stable sample id (e.g. the file name), so
+    the sample's noise does not depend on batch size, batch position, sharding or resuming.
+    """
+    digest = hashlib.sha256(f"{seed}:{sample_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "little") & ((1 << 63) - 1)
+
+
+def derive_generators(seed: int, sample_ids: list, device="cuda") -> List[torch.Generator]:
+    """
+    One `torch.Generator` per sample, seeded with `derive_seed(seed, sample_id)`; pass the list as `generator`.
+    """
+    return [torch.Generator(device=device).manual_seed(derive_seed(seed, sample_id)) for sample_id in sample_ids]
+
+
 def init_accelerator(config):
     accelerator_project_config = ProjectConfiguration(
         project_dir=config.project_name,
@@ -382,6 +432,47 @@ def resize_and_padding(image, size):
     return padding
 
 
+def resize_and_padding_tensor(image: torch.Tensor, size):
+    """
+    Tensor version of `resize_and_padding` for a batch of images in [-1, 1]: fit inside `size` (w, h) keeping the
+    aspect ratio and pad with white.
+    """
+    h, w = image.shape[-2:]
+    target_w, target_h = size
+    if w / h < target_w / target_h:
+        new_h = target_h
+        new_w = w * target_h // h
+    else:
+        new_w = target_w
+        new_h = h * target_w // w
+    resized = torch.nn.functional.interpolate(image, size=(new_h, new_w), mode="bicubic", antialias=True).clamp(-1, 1)
+    padding = torch.ones(*image.shape[:-2], target_h, target_w, dtype=image.dtype, device=image.device)
+    top, left = (target_h - new_h) // 2, (target_w - new_w) // 2
+    padding[..., top:top + new_h, left:left + new_w] = resized
+    return padding
+
+
+def mask_crop_box(mask_latent: torch.Tensor, padding: float = 0.1, align: int = 8):
+    """
+    Bounding box (top, left, bottom, right) of the masked area of a latent-resolution mask, united over the batch,
+    padded by `padding` of each side length and aligned to `align` latent cells.
+    Returns None when nothing is masked or the box would cover the whole latent.
+    """
+    occupied = (mask_latent > 0.5).flatten(0, -3).any(0)
+    rows, cols = occupied.any(1).nonzero(), occupied.any(0).nonzero()
+    if rows.numel() == 0:
+        return None
+    h, w = occupied.shape
+    pad_h, pad_w = int(round(padding * h)), int(round(padding * w))
+    top = max(rows[0].item() - pad_h, 0) // align * align
+    left = max(cols[0].item() - pad_w, 0) // align * align
+    bottom = min(-(-(rows[-1].item() + 1 + pad_h) // align) * align, h)
+    right = min(-(-(cols[-1].item() + 1 + pad_w) // align) * align, w)
+    if (top, left, bottom, right) == (0, 0, h, w):
+        return None
+    return top, left, bottom, right
+
+
 def scan_files_in_dir(directory, postfix: Set[str] = None, progress_bar: tqdm = None) -> list:
     file_list = []
     progress_bar = tqdm(total=0, desc=f"Scanning", ncols=100) if progress_bar is None else progress_bar